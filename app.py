@@ -8,17 +8,27 @@ from flask import (
     url_for,
     flash,
     make_response,
+    copy_current_request_context,
+    jsonify,
 )
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import pytz
 import functools
+import hashlib
+import threading
+import time
 from dotenv import load_dotenv
-from googleapiclient.discovery import build
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from utils.storage import (
-    load_config,
-    load_data,
+    get_config,
+    get_config_version,
+    get_data_version,
+    get_document_version,
+    load_history_page,
     save_data,
     delete_data,
     get_latest_mood,
@@ -28,15 +38,24 @@ from utils.storage import (
 from utils.fitbit import (
     fitbit_login,
     fitbit_callback,
+    get_access_token,
     get_fitbit_data,
     save_fitbit_data,
+    has_fitbit_tokens,
+    load_fitbit_today,
+    get_fitbit_stats,
+    FITBIT_TODAY_NAME,
+    FITBIT_TOKENS_NAME,
 )
+from utils.analytics import get_insights
+from utils.intraday import load_series
+from utils.ingest import INGEST_MODE, start_scheduler
 from utils.calendar_api import (
     calendar_login,
     calendar_callback,
-    get_weekly_summary,
-    get_calendar_events,
-    get_credentials,
+    get_calendar_data,
+    CALENDAR_CACHE_NAME,
+    CALENDAR_CREDENTIALS_NAME,
 )
 from feedback import FeedbackSystem
 
@@ -50,15 +69,31 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 # Timezone for Paris
 paris_tz = pytz.timezone("Europe/Paris")
 
-# Load config
-config_path = os.getenv("CONFIG_PATH", "config.json")
-config = load_config(config_path)
+# Thread pool and per-source timeouts (seconds) for the dashboard upstream calls
+executor = ThreadPoolExecutor(max_workers=8)
+CALENDAR_TIMEOUT = float(os.getenv("CALENDAR_TIMEOUT", "10"))
+FITBIT_TIMEOUT = float(os.getenv("FITBIT_TIMEOUT", "10"))
+
+# Rows per history page
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+RECORD_TYPES = ["Mood", "Event", "Health", "Sleep", "Steps", "Weight"]
 
 # Initialize the feedback system
 feedback_system = FeedbackSystem(exit_on_feedback=True)
 feedback_system.init_app(app, enable_in_debug=True, enable_in_prod=False)
 
 
+def start_background_ingest():
+    """
+    Starts the ingestion thread when INGEST_MODE is 'thread'. Called by the
+    server entry points (gunicorn.conf.py, `python app.py`), not on import, so
+    that tests and scripts importing the app do not ingest.
+    """
+    if INGEST_MODE == "thread":
+        start_scheduler(paris_tz)
+
+
 # Login verification decorator
 def login_required(f):
     @functools.wraps(f)
@@ -72,11 +107,65 @@ def login_required(f):
     return decorated_function
 
 
+# Rendered pages: (page, versions of what it shows) -> (ETag, body)
+PAGE_CACHE_SIZE = 64
+_page_cache = OrderedDict()
+_page_cache_lock = threading.Lock()
+
+
+def page_key(*versions):
+    """
+    Cache key of the current page: its URL, the versions of the data and the
+    config, the current hour (for dates and weeks shown), and other versions.
+    """
+    return (
+        request.full_path,
+        get_data_version(),
+        get_config_version(),
+        datetime.now(paris_tz).strftime("%Y-%m-%d %H"),
+        *versions,
+    )
+
+
+def render_cached(key, render):
+    """
+    Returns the page rendered by render(), with a strong ETag so that browsers
+    having it get a 304 without body. The page is cached under key, unless key
+    is None or messages were flashed: they are only shown once.
+    """
+    if "_flashes" in session:
+        key = None
+    cached = None
+    if key is not None:
+        with _page_cache_lock:
+            cached = _page_cache.get(key)
+            if cached:
+                _page_cache.move_to_end(key)
+    if cached is None:
+        body = render()
+        cached = (hashlib.sha256(body.encode()).hexdigest()[:32], body)
+        if key is not None:
+            with _page_cache_lock:
+                _page_cache[key] = cached
+                while len(_page_cache) > PAGE_CACHE_SIZE:
+                    _page_cache.popitem(last=False)
+
+    etag, body = cached
+    response = make_response(body)
+    response.set_etag(etag)
+    # Private pages, revalidated on each view
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
 @app.route("/")
 @login_required
 def home():
-    current_mood = get_latest_mood()
-    return render_template("home.html", current_mood=current_mood)
+    return render_cached(
+        page_key(),
+        lambda: render_template("home.html", current_mood=get_latest_mood()),
+    )
 
 
 @app.route("/mood", methods=["GET", "POST"])
@@ -95,7 +184,7 @@ def mood():
         now = datetime.now(paris_tz)
         current_date = now.strftime("%Y-%m-%d")
         current_hour = now.hour
-        mood_config = config.get("moods", {})
+        mood_config = get_config().get("moods", {})
         return render_template(
             "mood.html",
             current_date=current_date,
@@ -119,7 +208,7 @@ def events():
         now = datetime.now(paris_tz)
         current_date = now.strftime("%Y-%m-%d")
         current_hour = now.hour
-        events = config.get("events", {})
+        events = get_config().get("events", {})
         return render_template(
             "events.html",
             current_date=current_date,
@@ -143,7 +232,7 @@ def health():
         now = datetime.now(paris_tz)
         current_date = now.strftime("%Y-%m-%d")
         current_hour = now.hour
-        events = config.get("health", {})
+        events = get_config().get("health", {})
         return render_template(
             "health.html",
             current_date=current_date,
@@ -152,6 +241,29 @@ def health():
         )
 
 
+# Concurrent upstream calls for the dashboard
+def submit_in_context(f, *args, **kwargs):
+    "Runs f in the thread pool with access to the current request and session"
+    return executor.submit(copy_current_request_context(f), *args, **kwargs)
+
+
+def wait_for(future, source, deadline, raise_errors=False):
+    """
+    Returns the result of a future, or None if it is not done by the deadline.
+    Errors are logged and ignored unless raise_errors is set.
+    """
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except FuturesTimeoutError:
+        print(f"Timed out waiting for {source}")
+        return None
+    except Exception as e:
+        if raise_errors:
+            raise
+        print(f"Error fetching {source}: {e}")
+        return None
+
+
 # Utility functions for formatting time displays
 def format_hours_to_int(dict_obj):
     """Format decimal hours to integer hours"""
@@ -173,6 +285,24 @@ def format_sleep_time(hours):
 @app.route("/dashboard")
 @login_required
 def dashboard():
+    key = None
+    if INGEST_MODE != "request":
+        # Only saved data is shown, the page changes with it
+        key = page_key(
+            *(
+                get_document_version(name)
+                for name in (
+                    FITBIT_TODAY_NAME,
+                    FITBIT_TOKENS_NAME,
+                    CALENDAR_CACHE_NAME,
+                    CALENDAR_CREDENTIALS_NAME,
+                )
+            )
+        )
+    return render_cached(key, render_dashboard)
+
+
+def render_dashboard():
     fitbit_configured = all(
         [os.getenv("FITBIT_CLIENT_ID"), os.getenv("FITBIT_CLIENT_SECRET")]
     )
@@ -180,40 +310,85 @@ def dashboard():
         [os.getenv("CALENDAR_CLIENT_ID"), os.getenv("CALENDAR_CLIENT_SECRET")]
     )
 
-    # Check if calendar authentication is required
-    calendar_events = None
-    calendar_auth_required = False
-    weekly_summary = None
+    # Start upstream calls concurrently, each with its own deadline
+    start_time = time.monotonic()
+    calendar_deadline = start_time + CALENDAR_TIMEOUT
+    fitbit_deadline = start_time + FITBIT_TIMEOUT
 
+    # With background ingestion, only saved data is read
+    background_ingest = INGEST_MODE != "request"
+
+    calendar_future = None
     if calendar_configured:
-        calendar_events = get_calendar_events()
-        if calendar_events is None:
-            calendar_auth_required = True
-        else:
-            # Get weekly summary for categories
-            credentials = get_credentials()
-            service = build("calendar", "v3", credentials=credentials)
-            weekly_summary = get_weekly_summary(service)
+        # Get events and weekly summary for categories
+        calendar_future = submit_in_context(get_calendar_data, cached=background_ingest)
 
-    # Check if Fitbit authentication is required
+    fitbit_futures = None
+    fitbit_auth_required = False
     steps = None
     sleep = None
-    fitbit_auth_required = False
-
-    if fitbit_configured:
+    if fitbit_configured and background_ingest:
+        fitbit_auth_required = not has_fitbit_tokens()
+        steps, sleep = load_fitbit_today(datetime.now(paris_tz).strftime("%Y-%m-%d"))
+    elif fitbit_configured:
         now = datetime.now(paris_tz)
         try:
+            # Refresh the token once, before concurrent calls use it
+            get_access_token()
+            backfill_future = None
             if ("last_fitbit_check" not in session) or (
                 now - session["last_fitbit_check"] >= timedelta(days=1)
             ):
-                save_fitbit_data(timezone=paris_tz)
-                session["last_fitbit_check"] = now
-            steps, sleep = get_fitbit_data(now.strftime("%Y-%m-%d"))
-            # Format sleep time as hours and minutes
-            if sleep is not None:
-                sleep = format_sleep_time(sleep)
+                backfill_future = submit_in_context(save_fitbit_data, timezone=paris_tz)
+            today_future = submit_in_context(get_fitbit_data, now.strftime("%Y-%m-%d"))
+            fitbit_futures = (backfill_future, today_future)
+        except ValueError:
+            fitbit_auth_required = True
+
+    # Local analytics run while upstream calls are in flight
+    insights = None
+    try:
+        insights = get_insights(datetime.now(paris_tz).date())
+    except Exception as e:
+        print(f"Error computing insights: {e}")
+
+    # Check if calendar authentication is required
+    calendar_events = None
+    calendar_auth_required = False
+    weekly_summary = None
+
+    if calendar_future:
+        # Nothing is shown if the calendar is too slow to answer
+        calendar_data = wait_for(calendar_future, "calendar", calendar_deadline)
+        if calendar_data:
+            calendar_events, weekly_summary = calendar_data
+            calendar_auth_required = calendar_events is None
+
+    # Check if Fitbit authentication is required
+    if fitbit_futures:
+        backfill_future, today_future = fitbit_futures
+        try:
+            if backfill_future:
+                wait_for(backfill_future, "Fitbit backfill", fitbit_deadline, True)
+                if backfill_future.done():
+                    session["last_fitbit_check"] = now
         except ValueError:
             fitbit_auth_required = True
+        except Exception as e:
+            # The backfill is retried on the next visit
+            print(f"Error saving Fitbit data: {e}")
+        try:
+            steps, sleep = wait_for(
+                today_future, "Fitbit data", fitbit_deadline, True
+            ) or (None, None)
+        except ValueError:
+            fitbit_auth_required = True
+        except Exception as e:
+            print(f"Error fetching Fitbit data: {e}")
+
+    # Format sleep time as hours and minutes
+    if sleep is not None:
+        sleep = format_sleep_time(sleep)
 
     # Apply integer hours formatting to weekly_summary data
     if weekly_summary:
@@ -227,31 +402,99 @@ def dashboard():
         weekly_summary=weekly_summary,
         fitbit_required=fitbit_auth_required,
         calendar_required=calendar_auth_required,
+        insights=insights,
     )
 
 
 @app.route("/history")
 @login_required
 def history():
-    data = load_data()[::-1]
-    show_all = request.args.get("show_all") == "true"
-    if show_all:
-        recent_data = data
-    else:
-        recent_data = data[:20]
-    return render_template("history.html", data=recent_data)
+    as_json = request.args.get("format") == "json"
+    filters = {
+        "record_type": request.args.get("type") or None,
+        "start": request.args.get("start") or None,
+        "end": request.args.get("end") or None,
+    }
+    try:
+        limit = int(request.args.get("limit", HISTORY_PAGE_SIZE))
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+        before = request.args.get("before") or None
+        if not as_json:
+            # Rows are only loaded when the page is not cached
+            return render_cached(
+                page_key(),
+                lambda: render_history(limit, before, filters),
+            )
+        rows, next_cursor = load_history_page(limit, before, **filters)
+    except ValueError:
+        if as_json:
+            return jsonify({"error": "Invalid history parameters."}), 400
+        flash("Invalid history parameters.", "error")
+        return redirect(url_for("history"))
+
+    response = jsonify(
+        {
+            "rows": [
+                {
+                    "id": row.id,
+                    "date": row.date,
+                    "type": row.type,
+                    "value": row.value,
+                    "comment": row.comment,
+                }
+                for row in rows
+            ],
+            "next": next_cursor,
+        }
+    )
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def render_history(limit, before, filters):
+    rows, next_cursor = load_history_page(limit, before, **filters)
+    # Filters are kept in the pagination links
+    filter_args = {
+        name: request.args[name]
+        for name in ("type", "start", "end", "limit")
+        if request.args.get(name)
+    }
+    return render_template(
+        "history.html",
+        data=rows,
+        next_cursor=next_cursor,
+        filter_args=filter_args,
+        record_types=RECORD_TYPES,
+    )
+
+
+@app.route("/intraday")
+@login_required
+def intraday():
+    """
+    Intraday Fitbit series as JSON, downsampled for plotting, e.g.
+    ?series=heart&start=2024-05-01&end=2024-05-31&resolution=1440
+    """
+    today = datetime.now(paris_tz).strftime("%Y-%m-%d")
+    start = request.args.get("start") or today
+    try:
+        timestamps, values = load_series(
+            request.args.get("series", "heart"),
+            start,
+            request.args.get("end") or start,
+            int(request.args.get("resolution", 60)),
+        )
+    except ValueError:
+        return jsonify({"error": "Invalid intraday parameters."}), 400
+    return jsonify({"timestamps": timestamps, "values": values})
 
 
 @app.route("/delete", methods=["POST"])
 @login_required
 def delete_record():
-    date = request.form.get("date")
-    record_type = request.form.get("type")
-    value = request.form.get("value")
-    comment = request.form.get("comment")
-    row = [date, record_type, value, comment]
+    record_id = request.form.get("id")
     try:
-        delete_data(row)
+        delete_data(record_id)
         flash("Record deleted successfully.", "success")
     except ValueError as e:
         flash(str(e), "error")
@@ -300,10 +543,19 @@ def logout():
 app.add_url_rule("/fitbit_login", "fitbit_login", fitbit_login)
 app.add_url_rule("/fitbit_callback", "fitbit_callback", fitbit_callback)
 
+
+@app.route("/fitbit_stats")
+@login_required
+def fitbit_stats():
+    "Fitbit call counters and latencies of this worker, for monitoring"
+    return jsonify(get_fitbit_stats())
+
+
 # Calendar routes
 app.add_url_rule("/calendar_login", "calendar_login", calendar_login)
 app.add_url_rule("/calendar_callback", "calendar_callback", calendar_callback)
 
 
 if __name__ == "__main__":
+    start_background_ingest()
     app.run(host="0.0.0.0", port=8080)
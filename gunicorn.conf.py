@@ -0,0 +1,9 @@
+# Loaded by gunicorn from the working directory
+
+
+def post_worker_init(worker):
+    # Each worker starts its ingestion thread: runs are single-flight across
+    # the workers, through the ingest lock
+    from app import start_background_ingest
+
+    start_background_ingest()
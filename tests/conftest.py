@@ -0,0 +1,21 @@
+import os
+import pytest
+
+from utils import storage
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def data_file(tmp_path, monkeypatch):
+    "Points the storage module to a data file in a temporary directory"
+    file_name = str(tmp_path / "data.csv")
+    monkeypatch.setenv("CONFIG_PATH", os.path.join(REPO_DIR, "config.json"))
+    monkeypatch.setattr(storage, "LOCAL_STORAGE", True)
+    monkeypatch.setattr(storage, "FILE_NAME", file_name)
+    monkeypatch.setattr(storage, "JOURNAL_FILE_NAME", f"{file_name}.journal")
+    monkeypatch.setattr(storage, "JOURNAL_MODE", False)
+    monkeypatch.setattr(storage, "backend", storage.FileStorage())
+    monkeypatch.setattr(storage, "_record_store", None)
+    monkeypatch.setattr(storage, "_base", {"version": None, "rows": None})
+    return file_name
@@ -0,0 +1,46 @@
+import pytest
+
+from utils import analytics, storage
+from utils.analytics import HistoryColumns
+
+
+@pytest.fixture
+def columns(data_file, monkeypatch):
+    "Resets the columns cached by the analytics module"
+    monkeypatch.setattr(
+        analytics, "_columns", {"store": None, "config_version": None, "columns": None}
+    )
+
+
+def queries(columns):
+    return (
+        [list(values) for values in columns.daily_mood()],
+        [list(values) for values in columns.daily_values("Weight")],
+        columns.mood_by_label("Event"),
+    )
+
+
+def test_columns_updated_by_writes(columns, data_file):
+    storage.save_rows(
+        [
+            ["2024-01-01 - 9h", "Mood", "😐", ""],
+            ["2024-01-01 - 10h", "Event", "Sport", ""],
+            ["2024-01-02 - 9h", "Weight", "70.5", ""],
+        ]
+    )
+    first = analytics.get_history_columns()
+
+    storage.save_data(["2024-01-02 - 9h", "Mood", "😁", ""])
+    storage.save_data(["2024-01-02 - 10h", "Event", "Sport", ""])
+    storage.delete_data(storage.get_record_store().rows[0].id)
+    columns = analytics.get_history_columns()
+
+    # The new rows are appended, the deleted one left out of the queries
+    assert columns is not first
+    assert len(columns.days) == 5
+    assert len(first.days) == 3
+    moods = storage.get_config()["moods"]
+    assert queries(columns) == queries(
+        HistoryColumns(storage.get_record_store().rows, moods)
+    )
+    assert queries(columns)[1][1] == [70.5]
@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("feedback")
+
+import app as lifepulse  # noqa: E402
+
+
+@pytest.fixture
+def client(data_file, monkeypatch):
+    "Returns a logged-in client of the app, with an empty page cache"
+    monkeypatch.setenv("PASSWORD", "password")
+    monkeypatch.setattr(lifepulse, "_page_cache", lifepulse.OrderedDict())
+    client = lifepulse.app.test_client()
+    client.set_cookie("auth_token", "password")
+    return client
+
+
+def test_unchanged_page_not_modified(client):
+    response = client.get("/")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+    assert "no-cache" in response.headers["Cache-Control"]
+
+    response = client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.get_data() == b""
+
+    # A new mood changes the page
+    client.post("/mood", data={"date": "2024-02-01", "hour": "9", "mood": "🙂"})
+    client.get("/")
+    response = client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_flashed_messages_not_cached(client):
+    etag = client.get("/").headers["ETag"]
+    with client.session_transaction() as session:
+        session["_flashes"] = [("success", "Saved for once.")]
+
+    # Rendered with the message even though the browser has the page
+    response = client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert "Saved for once." in response.get_data(as_text=True)
+
+    # Shown once: the next view is the cached page again
+    response = client.get("/")
+    assert response.headers["ETag"] == etag
+    assert "Saved for once." not in response.get_data(as_text=True)
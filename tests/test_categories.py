@@ -0,0 +1,50 @@
+import random
+
+from utils.categories import CategoryClassifier, get_category_classifier
+
+
+def classify_first_match(categories, title):
+    "The loop replaced by CategoryClassifier: the first matching category wins"
+    for category, keywords in categories:
+        if any(keyword.lower() in title.lower() for keyword in keywords):
+            return category
+    return "Other"
+
+
+def test_classifier_matches_first_match_loop():
+    rng = random.Random(0)
+    # A small alphabet, so that keywords overlap and are shared by categories
+    alphabet = "abcAB -é"
+    for _ in range(200):
+        categories = [
+            (
+                f"Category {index}",
+                [
+                    "".join(rng.choices(alphabet, k=rng.randint(1, 3)))
+                    for _ in range(rng.randint(0, 4))
+                ],
+            )
+            for index in range(rng.randint(0, 6))
+        ]
+        classifier = CategoryClassifier(categories)
+        titles = [
+            "".join(rng.choices(alphabet, k=rng.randint(0, 12))) for _ in range(50)
+        ]
+        expected = [classify_first_match(categories, title) for title in titles]
+        assert classifier.classify_many(titles) == expected
+
+
+def test_classifier_from_config():
+    classifier = get_category_classifier(
+        {
+            "Fun": {"keywords": ["run"]},
+            "Sport": {"target": 9, "keywords": ["Running", "Swimming"]},
+            "Reading": {"target": 3},
+        }
+    )
+    assert classifier.classify("Morning RUNNING") == "Fun"
+    assert classifier.classify("Swimming pool") == "Sport"
+    assert classifier.classify("Book club") == "Other"
+    assert get_category_classifier({"Fun": {"keywords": ["run"]}}).classify("") == (
+        "Other"
+    )
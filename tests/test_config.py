@@ -0,0 +1,67 @@
+import json
+import pytest
+
+from utils import storage
+
+
+@pytest.fixture
+def config_file(tmp_path, monkeypatch):
+    "Points the config to a file in a temporary directory"
+    path = tmp_path / "config.json"
+    monkeypatch.setenv("CONFIG_PATH", str(path))
+    monkeypatch.setattr(
+        storage,
+        "_config",
+        {"path": None, "version": None, "data": None, "checked_at": 0},
+    )
+    monkeypatch.setattr(storage, "_config_derived", {})
+    return path
+
+
+def write_config(path, categories):
+    path.write_text(json.dumps({"calendar_events": categories}))
+
+
+def test_config_reloaded_when_changed(config_file):
+    write_config(config_file, {"Sport": {"target": 3, "keywords": ["run"]}})
+    config = storage.get_config()
+    classifier = storage.get_calendar_classifier()
+    version = storage.get_config_version()
+    assert classifier.classify("Morning run") == "Sport"
+
+    # Unchanged: the parsed config and what is derived from it are reused
+    assert storage.get_config() is config
+    assert storage.get_calendar_classifier() is classifier
+    assert storage.get_config_version() == version
+
+    write_config(config_file, {"Reading": {"target": 12, "keywords": ["run"]}})
+    assert storage.get_config()["calendar_events"] == {
+        "Reading": {"target": 12, "keywords": ["run"]}
+    }
+    assert storage.get_config_version() != version
+    assert storage.get_calendar_classifier().classify("Morning run") == "Reading"
+    assert storage.get_calendar_targets() == {"Reading": 12, "Other": 0}
+
+
+def test_config_on_gcs_revalidated_periodically(config_file, monkeypatch):
+    monkeypatch.setenv("CONFIG_PATH", "gs://bucket/config.json")
+    fetches = []
+    blob = {"generation": 1, "text": json.dumps({"moods": {"a": "A"}})}
+
+    def fetch_blob(name, bucket_name=None):
+        fetches.append((bucket_name, name))
+        return blob["generation"], blob["text"]
+
+    now = [1000.0]
+    monkeypatch.setattr(storage, "_fetch_blob", fetch_blob)
+    monkeypatch.setattr(storage.time, "monotonic", lambda: now[0])
+
+    assert storage.get_config() == {"moods": {"a": "A"}}
+    blob.update(generation=2, text=json.dumps({"moods": {"b": "B"}}))
+    # Served without a request until CONFIG_REVALIDATE_SECONDS have passed
+    assert storage.get_config() == {"moods": {"a": "A"}}
+    assert fetches == [("bucket", "config.json")]
+
+    now[0] += storage.CONFIG_REVALIDATE_SECONDS
+    assert storage.get_config() == {"moods": {"b": "B"}}
+    assert len(fetches) == 2
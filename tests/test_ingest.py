@@ -0,0 +1,33 @@
+import threading
+import pytz
+
+from utils import ingest
+from utils.storage import document_lock
+
+
+def test_ingest_skipped_while_running(data_file, monkeypatch):
+    runs = []
+    monkeypatch.setattr(ingest, "FITBIT_CLIENT_ID", "id")
+    monkeypatch.setattr(ingest, "FITBIT_CLIENT_SECRET", "secret")
+    monkeypatch.setattr(ingest, "ingest_fitbit", runs.append)
+    timezone = pytz.timezone("Europe/Paris")
+
+    # Another worker holds the lock: the ingestion does not wait for it
+    locked, release = threading.Event(), threading.Event()
+
+    def hold_lock():
+        with document_lock(ingest.INGEST_LOCK_NAME):
+            locked.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    locked.wait(5)
+    try:
+        assert ingest.ingest(timezone) is False
+    finally:
+        release.set()
+        thread.join()
+    assert runs == []
+    assert ingest.ingest(timezone) is True
+    assert runs == [timezone]
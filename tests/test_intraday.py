@@ -0,0 +1,68 @@
+import random
+import pytest
+
+from utils import intraday
+
+
+@pytest.fixture
+def months(data_file, monkeypatch):
+    "Clears the month documents cached by the intraday module"
+    monkeypatch.setattr(intraday, "_months", {})
+
+
+def downsample(values, interval, resolution, aggregate):
+    """
+    Plain loop over the values of one saved day, to compare load_series with:
+    missing values are no heart rate measured, or no steps
+    """
+    group = resolution // interval
+    results = []
+    for i in range(0, len(values), group):
+        values_of_group = [value or 0 for value in values[i : i + group]]
+        if aggregate == "sum":
+            results.append(round(float(sum(values_of_group)), 1))
+            continue
+        measured = [value for value in values_of_group if value > 0]
+        results.append(round(sum(measured) / len(measured), 1) if measured else None)
+    return results
+
+
+@pytest.mark.parametrize("series", ["heart", "steps"])
+@pytest.mark.parametrize("resolution", [15, 60, 360, 1440])
+def test_series_downsampled(months, series, resolution):
+    rng = random.Random(0)
+    info = intraday.SERIES[series]
+    count = intraday.MINUTES_PER_DAY // info["interval"]
+    days = {}
+    for day in ("2024-01-31", "2024-02-02"):
+        days[day] = [
+            None if rng.random() < 0.2 else rng.randint(0, 180) for _ in range(count)
+        ]
+        # A whole hour without measurements
+        days[day][: 60 // info["interval"]] = [None] * (60 // info["interval"])
+        intraday.save_day(series, day, days[day])
+
+    timestamps, values = intraday.load_series(
+        series, "2024-01-31", "2024-02-02", resolution
+    )
+    per_day = intraday.MINUTES_PER_DAY // resolution
+    assert len(values) == 3 * per_day
+    assert timestamps[0] == "2024-01-31T00:00"
+    assert timestamps[per_day] == "2024-02-01T00:00"
+    expected = downsample(
+        days["2024-01-31"], info["interval"], resolution, info["aggregate"]
+    )
+    expected += [None] * per_day
+    expected += downsample(
+        days["2024-02-02"], info["interval"], resolution, info["aggregate"]
+    )
+    assert values == expected
+
+
+def test_series_invalid_queries(months):
+    with pytest.raises(ValueError):
+        intraday.load_series("steps", "2024-01-01", "2024-01-01", 5)
+    with pytest.raises(ValueError):
+        intraday.load_series("heart", "2024-01-02", "2024-01-01")
+    with pytest.raises(ValueError):
+        intraday.load_series("heart", "2020-01-01", "2024-01-01", 1)
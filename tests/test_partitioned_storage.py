@@ -0,0 +1,147 @@
+import os
+from datetime import date
+import pytest
+from google.api_core.exceptions import PreconditionFailed
+
+from utils import analytics, storage
+from utils.partitioned_storage import PartitionedStorage
+from utils.records import RecordStore
+
+
+def write_file(name, lines):
+    with open(name, mode="w", newline="") as file:
+        file.write("".join(f"{line}\n" for line in lines))
+
+
+@pytest.fixture
+def partitioned(data_file, monkeypatch):
+    backend = PartitionedStorage(os.path.splitext(data_file)[0])
+    monkeypatch.setattr(storage, "backend", backend)
+    return backend
+
+
+def partition_names(backend):
+    manifest = backend._read_manifest()[1]
+    return {month: p["name"] for month, p in manifest["partitions"].items()}
+
+
+def test_partitions_replaced_on_write(partitioned):
+    storage.save_rows(
+        [
+            ["2024-01-10 - 9h", "Mood", "a", ""],
+            ["2024-02-10 - 9h", "Mood", "b", ""],
+        ]
+    )
+    names = partition_names(partitioned)
+    assert sorted(names) == ["2024-01", "2024-02"]
+
+    storage.save_data(["2024-02-01 - 9h", "Sleep", "7", ""])
+    new_names = partition_names(partitioned)
+    # Only the partition of the written month is replaced, the old one removed
+    assert new_names["2024-01"] == names["2024-01"]
+    assert new_names["2024-02"] != names["2024-02"]
+    assert sorted(os.listdir(partitioned.prefix)) == sorted(
+        list(new_names.values()) + ["manifest.json"]
+    )
+
+    manifest = partitioned._read_manifest()[1]
+    assert manifest["revision"] == 2
+    assert manifest["partitions"]["2024-02"]["rows"] == 2
+    assert manifest["partitions"]["2024-02"]["types"] == {"Mood": 1, "Sleep": 1}
+
+    rows = storage.get_record_store().rows
+    assert [row.value for row in rows] == ["a", "7", "b"]
+    # Another process reads the same rows from the manifest
+    storage.backend = PartitionedStorage(partitioned.prefix)
+    assert storage.get_record_store().rows == rows
+    assert storage.load_history_page(1)[0][0].value == "b"
+
+
+def test_partitions_split_from_data_file(data_file, partitioned):
+    write_file(
+        data_file,
+        ["2024-01-10 - 9h,Mood,a,", "2024-02-10 - 9h,Mood,b,,id-b"],
+    )
+    rows = storage.get_record_store().rows
+    assert [row.value for row in rows] == ["a", "b"]
+    assert sorted(partition_names(partitioned)) == ["2024-01", "2024-02"]
+
+    storage.delete_data("id-b")
+    assert sorted(partition_names(partitioned)) == ["2024-01"]
+    assert storage.get_record_store().rows == rows[:1]
+
+
+def test_partitions_kept_when_manifest_commit_fails(partitioned, monkeypatch):
+    storage.save_data(["2024-01-10 - 9h", "Mood", "a", ""])
+    files = sorted(os.listdir(partitioned.prefix))
+    rows = storage.get_record_store().rows
+    write_text = storage._write_text
+
+    def conflicting_write_text(name, text, if_generation_match=None):
+        if name == partitioned.manifest_name:
+            raise PreconditionFailed("Manifest updated by another instance")
+        return write_text(name, text, if_generation_match)
+
+    monkeypatch.setattr(storage, "_write_text", conflicting_write_text)
+    monkeypatch.setattr(storage.time, "sleep", lambda seconds: None)
+    with pytest.raises(PreconditionFailed):
+        storage.save_data(["2024-01-11 - 9h", "Mood", "b", ""])
+
+    # The partitions written for the failed commit are removed
+    assert sorted(os.listdir(partitioned.prefix)) == files
+    storage.backend = PartitionedStorage(partitioned.prefix)
+    assert storage.get_record_store().rows == rows
+
+
+def test_pages_across_partitions(partitioned):
+    storage.save_rows(
+        [
+            [f"2024-{month:02d}-{day:02d} - 9h", "Mood", f"{month}/{day}", ""]
+            for month in (1, 2, 4)
+            for day in (1, 15, 28)
+        ]
+    )
+    store = RecordStore(storage.get_record_store().rows)
+    for limit in (1, 2, 4):
+        pages = []
+        expected = []
+        cursor = expected_cursor = None
+        while True:
+            page, cursor = storage.load_history_page(limit, cursor)
+            expected_page, expected_cursor = store.page(limit, expected_cursor)
+            pages.append(page)
+            expected.append(expected_page)
+            if cursor is None or expected_cursor is None:
+                break
+        assert pages == expected
+        assert cursor is None and expected_cursor is None
+
+
+def test_insights_without_partitions(partitioned, monkeypatch):
+    rows = [["2024-01-01 - 9h", "Mood", "😐", ""]]
+    for day in range(2, 20):
+        rows.append([f"2024-01-{day:02d} - 8h", "Sleep", str(6 + day % 3), ""])
+        rows.append([f"2024-01-{day:02d} - 9h", "Mood", "😁" if day % 3 else "😔", ""])
+        rows.append([f"2024-01-{day:02d} - 9h", "Mood", "🙂", ""])
+        if day % 2:
+            rows.append([f"2024-01-{day:02d} - 10h", "Event", "Sport", ""])
+    storage.save_rows(rows)
+    today = date(2024, 1, 20)
+    monkeypatch.setattr(
+        analytics, "_rollup_columns", {"version": None, "columns": None}
+    )
+    # Computed from every row
+    monkeypatch.setattr(analytics, "has_lazy_history", lambda: False)
+    expected = analytics.get_insights(today)
+    assert expected["sleep"] is not None
+    assert expected["events"]
+
+    # A new instance computes the same insights from the rollups only
+    monkeypatch.setattr(analytics, "has_lazy_history", storage.has_lazy_history)
+    storage.backend = PartitionedStorage(partitioned.prefix)
+
+    def no_record_store():
+        raise AssertionError("Every partition loaded")
+
+    monkeypatch.setattr(storage.backend, "get_record_store", no_record_store)
+    assert analytics.get_insights(today) == expected
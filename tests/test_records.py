@@ -0,0 +1,52 @@
+import pytest
+
+from utils.records import RecordStore
+
+
+def make_store(rows):
+    return RecordStore([row + [f"id-{i}"] for i, row in enumerate(rows)])
+
+
+def test_page_cursors_across_months():
+    store = make_store(
+        [
+            ["2024-01-31 - 9h", "Mood", "a", ""],
+            ["2024-01-31 - 9h", "Event", "b", ""],
+            ["2024-02-01 - 10h", "Mood", "c", ""],
+            ["2024-02-01 - 9h", "Mood", "d", ""],
+            ["2024-02-01T23:30", "Sleep", "7", ""],
+            ["2024-03-01 - 9h", "Mood", "e", ""],
+        ]
+    )
+    values, cursor, pages = [], None, 0
+    while True:
+        page, cursor = store.page(2, cursor)
+        values.extend(row.value for row in page)
+        pages += 1
+        if cursor is None:
+            break
+    # Most recent first, rows of the same hour in reverse file order
+    assert values == ["e", "7", "c", "d", "b", "a"]
+    assert pages == 3
+
+    page, cursor = store.page(2, record_type="Mood", start="2024-02-01")
+    assert [row.value for row in page] == ["e", "c"]
+    page, cursor = store.page(2, cursor, record_type="Mood", start="2024-02-01")
+    assert [row.value for row in page] == ["d"]
+    assert cursor is None
+
+
+def test_page_cursor_stable_after_writes():
+    rows = [[f"2024-01-{day:02d} - 9h", "Mood", str(day), ""] for day in range(1, 6)]
+    page, cursor = make_store(rows).page(2)
+    assert [row.value for row in page] == ["5", "4"]
+
+    # A row added after the first page is not returned again on the next one
+    rows.append(["2024-01-06 - 9h", "Mood", "6", ""])
+    page, cursor = make_store(rows).page(2, cursor)
+    assert [row.value for row in page] == ["3", "2"]
+
+
+def test_page_rejects_invalid_cursor():
+    with pytest.raises(ValueError):
+        make_store([]).page(2, "invalid")
@@ -0,0 +1,68 @@
+import pytest
+
+from utils import storage
+from utils.rollups import build_rollups
+
+
+def write_file(name, lines):
+    with open(name, mode="w", newline="") as file:
+        file.write("".join(f"{line}\n" for line in lines))
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    "Counts the rollups built from scratch"
+    calls = []
+
+    def counted_build_rollups(rows):
+        calls.append(len(rows))
+        return build_rollups(rows)
+
+    monkeypatch.setattr(storage, "build_rollups", counted_build_rollups)
+    return calls
+
+
+def days(rollups):
+    return sorted(rollups["days"])
+
+
+@pytest.mark.parametrize("journal_mode", [False, True])
+def test_rollups_updated_by_writes(data_file, monkeypatch, builds, journal_mode):
+    monkeypatch.setattr(storage, "JOURNAL_MODE", journal_mode)
+    monkeypatch.setattr(storage, "JOURNAL_COMPACT_THRESHOLD", 3)
+    storage.save_data(["2024-01-01 - 9h", "Mood", "a", ""])
+    assert days(storage.get_rollups()) == ["2024-01-01"]
+    assert builds == [1]
+
+    # Writes and compactions update the rollups without rebuilding them
+    for day in range(2, 6):
+        storage.save_data([f"2024-01-0{day} - 9h", "Steps", "100", ""])
+    storage.delete_data(storage.get_record_store().rows[0].id)
+    rollups = storage.get_rollups()
+    assert builds == [1]
+    assert rollups["days"] == build_rollups(storage.get_record_store().rows)["days"]
+    assert days(rollups) == ["2024-01-02", "2024-01-03", "2024-01-04", "2024-01-05"]
+
+
+def test_rollups_rebuilt_after_failed_update(data_file, monkeypatch):
+    storage.save_rows(
+        [["2024-01-01 - 9h", "Mood", "a", ""], ["2024-01-02 - 9h", "Mood", "b", ""]]
+    )
+    assert days(storage.get_rollups()) == ["2024-01-01", "2024-01-02"]
+
+    def failing_update_rollups(rollups, added=(), deleted=()):
+        raise ValueError("Rollups not updated")
+
+    # Same number of rows after the write, which is committed anyway
+    monkeypatch.setattr(storage, "update_rollups", failing_update_rollups)
+    storage.delete_data(storage.get_record_store().rows[0].id)
+    storage.save_data(["2024-01-05 - 9h", "Mood", "c", ""])
+    assert days(storage.get_rollups()) == ["2024-01-02", "2024-01-05"]
+
+
+def test_rollups_rebuilt_after_file_edit(data_file):
+    write_file(data_file, ["2024-01-01 - 9h,Mood,a,,id-a"])
+    assert days(storage.get_rollups()) == ["2024-01-01"]
+
+    write_file(data_file, ["2024-01-05 - 9h,Mood,a,,id-a"])
+    assert days(storage.get_rollups()) == ["2024-01-05"]
@@ -0,0 +1,83 @@
+import csv
+import random
+
+from utils.records import RecordStore, assign_legacy_ids
+from utils.sqlite_storage import SQLiteStorage
+
+
+def all_pages(load_page, limit, **filters):
+    "Returns the rows of every page, following the cursors"
+    rows, cursor = [], None
+    while True:
+        page, cursor = load_page(limit, cursor, **filters)
+        rows.extend(page)
+        if cursor is None:
+            return rows
+
+
+def test_pages_match_file_backend(tmp_path):
+    rng = random.Random(0)
+    rows = [
+        [
+            f"2024-01-{rng.randint(1, 3):02d} - {rng.randint(8, 11)}h",
+            rng.choice(["Mood", "Event"]),
+            str(i),
+            "",
+        ]
+        for i in range(40)
+    ]
+    database = SQLiteStorage(str(tmp_path / "data.db"))
+    database.save_rows(rows)
+    # The same rows, in the order of the CSV data file
+    store = RecordStore(database.get_record_store().rows)
+
+    for filters in [
+        {},
+        {"record_type": "Mood"},
+        {"start": "2024-01-02", "end": "2024-01-02"},
+    ]:
+        for limit in (1, 3, 100):
+            expected = all_pages(store.page, limit, **filters)
+            assert all_pages(database.load_page, limit, **filters) == expected
+    assert len(all_pages(database.load_page, 7)) == 40
+
+
+def test_latest_mood_first_stored_on_ties(tmp_path):
+    database = SQLiteStorage(str(tmp_path / "data.db"))
+    # Hours are not zero-padded: "10h" sorts before "9h" in the date column
+    database.save_rows(
+        [
+            ["2024-01-02 - 10h", "Mood", "a", ""],
+            ["2024-01-02 - 9h", "Mood", "b", ""],
+            ["2024-01-02 - 10h", "Mood", "c", ""],
+            ["2024-01-02 - 11h", "Event", "d", ""],
+        ]
+    )
+    assert database.get_latest_mood().value == "a"
+    store = database.get_record_store()
+    assert store.latest_mood == database.get_latest_mood()
+
+
+def test_import_export_round_trip(tmp_path):
+    csv_path = tmp_path / "data.csv"
+    lines = [
+        "2024-01-01 - 9h,Mood,a,",
+        "2024-01-01 - 9h,Mood,a,",
+        '2024-01-02 - 9h,Event,"b, c",note,id-b',
+        "2024-01-03T07:00,Sleep,7.5,",
+    ]
+    csv_path.write_text("".join(f"{line}\n" for line in lines))
+    with open(csv_path, newline="") as file:
+        expected = list(csv.reader(file))
+    assign_legacy_ids(expected)
+
+    database = SQLiteStorage(str(tmp_path / "data.db"))
+    assert database.import_csv(str(csv_path)) == 4
+    # Rows already imported are skipped
+    assert database.import_csv(str(csv_path)) == 0
+    assert database.count() == 4
+
+    export_path = tmp_path / "export.csv"
+    assert database.export_csv(str(export_path)) == 4
+    with open(export_path, newline="") as file:
+        assert list(csv.reader(file)) == expected
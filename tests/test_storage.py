@@ -0,0 +1,169 @@
+import os
+import csv
+import time
+import threading
+import pytest
+
+from utils import storage
+
+
+def reload_data():
+    "Returns the rows read again from the files, as a new process would"
+    storage._record_store = None
+    storage._base = {"version": None, "rows": None}
+    return storage.get_record_store().rows
+
+
+def write_file(name, lines):
+    with open(name, mode="w", newline="") as file:
+        file.write("".join(f"{line}\n" for line in lines))
+
+
+def test_journal_rows_merged_in_file_order(data_file, monkeypatch):
+    monkeypatch.setattr(storage, "JOURNAL_MODE", True)
+    write_file(
+        data_file,
+        ["2024-01-01 - 9h,Mood,a,,id-a", "2024-01-02 - 9h,Mood,b,,id-b"],
+    )
+    storage.save_rows(
+        [["2024-01-02 - 9h", "Mood", "c", ""], ["2024-01-01 - 9h", "Mood", "d", ""]]
+    )
+    storage.save_data(["2024-01-02 - 9h", "Mood", "e", ""])
+    storage.save_data(["2023-12-31 - 9h", "Mood", "f", ""])
+
+    # Added rows go after the base rows of the same date, in the order added
+    expected = ["f", "a", "d", "b", "c", "e"]
+    assert os.path.exists(storage.JOURNAL_FILE_NAME)
+    assert [row.value for row in storage.get_record_store().rows] == expected
+    assert [row.value for row in reload_data()] == expected
+
+    # The base file written by compaction has the same order
+    rows = storage.get_record_store().rows
+    storage.compact_journal()
+    assert not os.path.exists(storage.JOURNAL_FILE_NAME)
+    assert reload_data() == rows
+
+
+def test_journal_deletes_by_id(data_file, monkeypatch):
+    monkeypatch.setattr(storage, "JOURNAL_MODE", True)
+    storage.save_rows([["2024-01-01 - 9h", "Mood", value, ""] for value in "abc"])
+    deleted = storage.get_record_store().rows[1]
+    storage.delete_data(deleted.id)
+
+    assert [row.value for row in reload_data()] == ["a", "c"]
+    with pytest.raises(ValueError):
+        storage.delete_data(deleted.id)
+
+
+def test_journal_replayed_once_after_failed_drop(data_file, monkeypatch):
+    monkeypatch.setattr(storage, "JOURNAL_MODE", True)
+    storage.save_rows([["2024-01-01 - 9h", "Mood", value, ""] for value in "abc"])
+    storage.delete_data(storage.get_record_store().rows[0].id)
+    rows = storage.get_record_store().rows
+    drop_journal = storage._drop_journal
+
+    def failing_drop_journal(store):
+        raise OSError("Journal not removed")
+
+    # The base file is written, the journal is left as it was
+    monkeypatch.setattr(storage, "_drop_journal", failing_drop_journal)
+    storage.compact_journal()
+    assert os.path.exists(storage.JOURNAL_FILE_NAME)
+    assert reload_data() == rows
+
+    monkeypatch.setattr(storage, "_drop_journal", drop_journal)
+    storage.save_data(["2024-01-02 - 9h", "Mood", "d", ""])
+    storage.delete_data(rows[0].id)
+    assert [row.value for row in reload_data()] == ["c", "d"]
+    storage.compact_journal()
+    assert not os.path.exists(storage.JOURNAL_FILE_NAME)
+    assert [row.value for row in reload_data()] == ["c", "d"]
+
+
+@pytest.mark.parametrize("journal_mode", [False, True])
+def test_legacy_rows_get_stable_ids(data_file, monkeypatch, journal_mode):
+    monkeypatch.setattr(storage, "JOURNAL_MODE", journal_mode)
+    # Rows saved before rows had IDs, two of them identical
+    write_file(
+        data_file,
+        [
+            "2024-01-01 - 9h,Mood,a,",
+            "2024-01-01 - 9h,Mood,a,",
+            "2024-01-02 - 9h,Sleep,7",
+        ],
+    )
+    rows = storage.get_record_store().rows
+    ids = [row.id for row in rows]
+    assert len(set(ids)) == 3
+    assert [row.id for row in reload_data()] == ids
+
+    storage.delete_data(ids[1])
+    assert [row.id for row in reload_data()] == [ids[0], ids[2]]
+    assert reload_data()[0] == rows[0]
+    with pytest.raises(ValueError):
+        storage.delete_data(ids[1])
+    if not journal_mode:
+        # IDs are written with the rows when the file is rewritten
+        with open(data_file, newline="") as file:
+            assert [row[4] for row in csv.reader(file)] == [ids[0], ids[2]]
+
+
+def wait_for_pending_writes(count):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with storage._pending_writes_lock:
+            if len(storage._pending_writes) >= count:
+                return
+        time.sleep(0.01)
+    raise AssertionError("Writes were not queued")
+
+
+def test_concurrent_writes_committed_together(data_file, monkeypatch):
+    storage.save_data(["2024-01-01 - 9h", "Mood", "a", ""])
+    existing_id = storage.get_record_store().rows[0].id
+    rewrites = []
+    rewrite = storage._rewrite
+
+    def counted_rewrite(store, rows):
+        rewrites.append(len(rows))
+        return rewrite(store, rows)
+
+    monkeypatch.setattr(storage, "_rewrite", counted_rewrite)
+
+    errors = {}
+
+    def run(key, function, *args):
+        try:
+            function(*args)
+        except ValueError as e:
+            errors[key] = e
+
+    threads = [
+        threading.Thread(
+            target=run,
+            args=(i, storage.save_data, [f"2024-01-0{i + 2} - 9h", "Mood", "b", ""]),
+        )
+        for i in range(5)
+    ]
+    threads.append(
+        threading.Thread(target=run, args=("unknown", storage.delete_data, "unknown"))
+    )
+    threads.append(
+        threading.Thread(
+            target=run, args=("existing", storage.delete_data, existing_id)
+        )
+    )
+    # Writes queued while a commit is in progress are committed in one rewrite
+    with storage._commit_lock:
+        for thread in threads:
+            thread.start()
+        wait_for_pending_writes(len(threads))
+    for thread in threads:
+        thread.join()
+
+    assert rewrites == [5]
+    # Only the failed write reports its error
+    assert list(errors) == ["unknown"]
+    assert [row.date[:10] for row in reload_data()] == [
+        f"2024-01-0{i + 2}" for i in range(5)
+    ]
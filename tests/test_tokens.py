@@ -0,0 +1,44 @@
+import pytest
+from cryptography.fernet import Fernet
+
+from utils import tokens
+from utils.storage import get_document_name
+
+
+@pytest.fixture
+def key(data_file, monkeypatch):
+    "Sets a new encryption key of the token store"
+    monkeypatch.setenv("TOKEN_ENCRYPTION_KEY", Fernet.generate_key().decode())
+    tokens._get_fernet.cache_clear()
+    yield
+    tokens._get_fernet.cache_clear()
+
+
+def test_tokens_encrypted(key, data_file):
+    tokens.save_tokens("fitbit_tokens.json", {"access_token": "secret"})
+    assert tokens.load_tokens("fitbit_tokens.json") == {"access_token": "secret"}
+    with open(get_document_name("fitbit_tokens.json")) as file:
+        assert "secret" not in file.read()
+
+
+def test_tokens_of_another_key_ignored(key, data_file, monkeypatch):
+    tokens.save_tokens("fitbit_tokens.json", {"access_token": "secret"})
+    monkeypatch.setenv("TOKEN_ENCRYPTION_KEY", Fernet.generate_key().decode())
+    tokens._get_fernet.cache_clear()
+    assert tokens.load_tokens("fitbit_tokens.json") is None
+
+
+@pytest.mark.parametrize("secret", [None, "secret_key", "your_flask_app_secret_key"])
+def test_tokens_not_stored_without_key(data_file, monkeypatch, secret):
+    monkeypatch.delenv("TOKEN_ENCRYPTION_KEY", raising=False)
+    if secret is None:
+        monkeypatch.delenv("APP_SECRET_KEY", raising=False)
+    else:
+        monkeypatch.setenv("APP_SECRET_KEY", secret)
+    tokens._get_fernet.cache_clear()
+    try:
+        with pytest.raises(ValueError):
+            tokens.save_tokens("fitbit_tokens.json", {"access_token": "secret"})
+        assert tokens.load_tokens("fitbit_tokens.json") is None
+    finally:
+        tokens._get_fernet.cache_clear()
@@ -0,0 +1,310 @@
+import copy
+import threading
+from datetime import timedelta
+import numpy as np
+
+from utils.records import Record, get_mood_scores, get_mood_score
+from utils.rollups import weekly_rollups, mood_average
+from utils.storage import (
+    get_record_store,
+    get_rollups,
+    get_config,
+    get_config_version,
+    has_lazy_history,
+)
+
+# Categorical codes of the record types
+TYPE_CODES = {"Mood": 0, "Event": 1, "Health": 2, "Sleep": 3, "Steps": 4, "Weight": 5}
+# Type code of the entries of deleted records, left out of every query
+DELETED_CODE = -2
+
+
+def parse_mood_score(value, mood_scores):
+    score = get_mood_score(value, mood_scores)
+    return np.nan if score is None else score
+
+
+def _parse_hour(record):
+    timestamp = record.timestamp
+    return timestamp.hour if timestamp else 0
+
+
+def _parse_days(rows):
+    try:
+        return np.array([row.day for row in rows], dtype="datetime64[D]")
+    except ValueError:
+        # Some dates are invalid: parse them one by one, leaving invalid ones out
+        days = np.full(len(rows), np.datetime64("NaT"), dtype="datetime64[D]")
+        for i, row in enumerate(rows):
+            try:
+                days[i] = np.datetime64(row.day, "D")
+            except ValueError:
+                pass
+        return days
+
+
+def _parse_value(row, mood_scores):
+    if row.type == "Mood":
+        return parse_mood_score(row.value, mood_scores)
+    if row.type in ("Sleep", "Steps", "Weight"):
+        try:
+            return float(row.value)
+        except ValueError:
+            return np.nan
+    return np.nan
+
+
+def _week_starts(days):
+    "Returns the Monday of the week of each day"
+    # Day 0 (1970-01-01) is a Thursday, 3 days after a Monday
+    offsets = (days.astype(np.int64) + 3) % 7
+    return days - offsets.astype("timedelta64[D]")
+
+
+class HistoryColumns:
+    """
+    Column-oriented copy of the history, for vectorized queries.
+
+    Each record becomes an entry of typed arrays: its day and hour, a categorical
+    type code, a numeric value (mood score, sleep hours, steps or weight, NaN
+    otherwise) and a label code for events and health conditions. Records added
+    later are appended at the end, and deleted ones get DELETED_CODE.
+    """
+
+    def __init__(self, rows, moods):
+        self.mood_scores = get_mood_scores(moods)
+        self.days = np.array([], dtype="datetime64[D]")
+        self.timestamps = np.array([], dtype="datetime64[h]")
+        self.type_codes = np.array([], dtype=np.int8)
+        self.values = np.array([], dtype=np.float64)
+        # Labels of events and health conditions, as codes into label_names
+        self.label_names = []
+        self.label_codes = np.array([], dtype=np.int32)
+        # Entry of each record ID, and number of entries of deleted records
+        self.positions = {}
+        self.deleted_count = 0
+        self._append(rows)
+
+    def _append(self, rows):
+        "Adds entries for the rows at the end of the arrays, without changing them"
+        days = _parse_days(rows)
+        hours = np.array([_parse_hour(row) for row in rows], dtype=np.int64)
+        timestamps = days.astype("datetime64[h]") + hours.astype("timedelta64[h]")
+        type_codes = np.array(
+            [TYPE_CODES.get(row.type, -1) for row in rows], dtype=np.int8
+        )
+        values = np.array(
+            [_parse_value(row, self.mood_scores) for row in rows], dtype=np.float64
+        )
+        label_codes = {name: code for code, name in enumerate(self.label_names)}
+        codes = []
+        for row in rows:
+            if row.type in ("Event", "Health"):
+                codes.append(label_codes.setdefault(row.value, len(label_codes)))
+            else:
+                codes.append(-1)
+        self.label_names = list(label_codes)
+
+        start = len(self.days)
+        self.positions.update((row.id, start + i) for i, row in enumerate(rows))
+        self.days = np.concatenate([self.days, days])
+        self.timestamps = np.concatenate([self.timestamps, timestamps])
+        self.type_codes = np.concatenate([self.type_codes, type_codes])
+        self.values = np.concatenate([self.values, values])
+        self.label_codes = np.concatenate(
+            [self.label_codes, np.array(codes, dtype=np.int32)]
+        )
+
+    def updated(self, added, deleted_ids):
+        """
+        Returns a copy of the columns with entries for the added records, and
+        the entries of the deleted ones left out. The columns are not changed,
+        as other threads may be reading them.
+        """
+        columns = copy.copy(self)
+        columns.positions = dict(self.positions)
+        deleted = [columns.positions.pop(record_id) for record_id in deleted_ids]
+        if deleted:
+            columns.type_codes = self.type_codes.copy()
+            columns.type_codes[deleted] = DELETED_CODE
+            columns.deleted_count += len(deleted)
+        columns._append(added)
+        return columns
+
+    def _mask(self, record_type, start=None, end=None):
+        mask = (self.type_codes == TYPE_CODES[record_type]) & ~np.isnat(self.days)
+        if start:
+            mask &= self.days >= np.datetime64(start, "D")
+        if end:
+            mask &= self.days <= np.datetime64(end, "D")
+        return mask
+
+    def _average_by(self, keys, values):
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        sums = np.bincount(inverse, weights=values, minlength=len(unique_keys))
+        counts = np.bincount(inverse, minlength=len(unique_keys))
+        return unique_keys, sums / counts
+
+    def daily_values(self, record_type, start=None, end=None):
+        "Returns the days having values of a type, and the average value of each day"
+        mask = self._mask(record_type, start, end) & ~np.isnan(self.values)
+        return self._average_by(self.days[mask], self.values[mask])
+
+    def daily_mood(self, start=None, end=None):
+        return self.daily_values("Mood", start, end)
+
+    def weekly_mood(self, start=None, end=None):
+        "Returns the Monday of each week with moods, and the average mood of the week"
+        mask = self._mask("Mood", start, end) & ~np.isnan(self.values)
+        return self._average_by(_week_starts(self.days[mask]), self.values[mask])
+
+    def mood_by_label(self, record_type="Event", start=None, end=None):
+        """
+        Compares the average mood of days with and without each event (or health
+        condition), considering days with a logged mood only.
+        """
+        mood_days, moods = self.daily_mood(start, end)
+        mask = self._mask(record_type, start, end)
+        label_codes = self.label_codes[mask]
+        label_days = self.days[mask]
+        results = []
+        for code in np.unique(label_codes):
+            with_label = np.isin(mood_days, label_days[label_codes == code])
+            days_with = int(with_label.sum())
+            if days_with == 0:
+                continue
+            results.append(
+                {
+                    "label": self.label_names[code],
+                    "days": days_with,
+                    "mood_with": float(moods[with_label].mean()),
+                    "mood_without": (
+                        float(moods[~with_label].mean())
+                        if days_with < len(moods)
+                        else None
+                    ),
+                }
+            )
+        results.sort(key=lambda result: result["days"], reverse=True)
+        return results
+
+    def mood_correlation(self, record_type, lag_days=1, start=None, end=None):
+        """
+        Returns the correlation between the daily values of a type and the mood
+        `lag_days` later, with the number of days compared, or None if there are
+        not enough days.
+        """
+        days, values = self.daily_values(record_type, start, end)
+        mood_days, moods = self.daily_mood()
+        _, value_index, mood_index = np.intersect1d(
+            days + np.timedelta64(lag_days, "D"), mood_days, return_indices=True
+        )
+        if len(value_index) < 3:
+            return None
+        x, y = values[value_index], moods[mood_index]
+        if x.std() == 0 or y.std() == 0:
+            return None
+        return float(np.corrcoef(x, y)[0, 1]), len(value_index)
+
+
+# Columns of the current data, updated when the data changes and rebuilt when
+# the config changes
+_columns = {"store": None, "config_version": None, "columns": None}
+_columns_lock = threading.Lock()
+
+
+def get_history_columns():
+    store = get_record_store()
+    config_version = get_config_version()
+    with _columns_lock:
+        columns, previous = _columns["columns"], _columns["store"]
+        if (
+            columns is None
+            or _columns["config_version"] != config_version
+            # Mostly deleted entries: cheaper to rebuild than to keep masking
+            or columns.deleted_count > len(store.rows)
+        ):
+            moods = get_config().get("moods", {})
+            columns = HistoryColumns(store.rows, moods)
+        elif previous.version != store.version:
+            # Only the records added or deleted since are parsed
+            added_ids = store.by_id.keys() - previous.by_id.keys()
+            deleted_ids = previous.by_id.keys() - store.by_id.keys()
+            added = [store.by_id[record_id] for record_id in added_ids]
+            columns = columns.updated(added, deleted_ids)
+        _columns.update(store=store, config_version=config_version, columns=columns)
+        return columns
+
+
+def rollup_records(rollups):
+    """
+    Returns records having the daily moods, labels and values of the day
+    rollups: one record per mood logged and per label, and the average sleep
+    and steps of each day. Hours and weights are not in the rollups.
+    """
+    records = []
+    for day, bucket in rollups["days"].items():
+        entries = [
+            ("Mood", mood)
+            for mood, count in bucket["moods"].items()
+            for _ in range(count)
+        ]
+        entries += [("Event", label) for label in bucket["events"]]
+        entries += [("Health", label) for label in bucket["health"]]
+        for record_type in ("Sleep", "Steps"):
+            total, count = bucket[record_type.lower()]
+            if count:
+                entries.append((record_type, str(total / count)))
+        records.extend(
+            Record(f"{day} - 0h", record_type, value, "", f"{day}/{i}")
+            for i, (record_type, value) in enumerate(entries)
+        )
+    return records
+
+
+# Columns of the day rollups, rebuilt when they or the config change
+_rollup_columns = {"version": None, "columns": None}
+
+
+def get_insight_columns(rollups):
+    """
+    Returns the columns the insights are computed from. They only compare
+    daily figures, which the day rollups have: with partitioned storage, the
+    columns are built from them rather than from every partition.
+    """
+    if not has_lazy_history():
+        return get_history_columns()
+    version = (rollups.get("data_version"), get_config_version())
+    with _columns_lock:
+        columns = _rollup_columns["columns"]
+        if columns is None or _rollup_columns["version"] != version:
+            moods = get_config().get("moods", {})
+            columns = HistoryColumns(rollup_records(rollups), moods)
+            _rollup_columns.update(version=version, columns=columns)
+        return columns
+
+
+def get_insights(today, weeks=4, events=5):
+    """
+    Returns the figures of the dashboard insights section: average mood of the
+    last weeks, mood on days with and without the most frequent events, and the
+    correlation of sleep and steps with mood.
+    """
+    # Recent weeks come from the rollups, without scanning the history
+    mood_scores = get_mood_scores(get_config().get("moods", {}))
+    start = (today - timedelta(weeks=weeks - 1)).isoformat()
+    rollups = get_rollups()
+    weekly_mood = []
+    for week, bucket in weekly_rollups(rollups, start, today.isoformat()):
+        mood = mood_average(bucket, mood_scores) if bucket else None
+        if mood is not None:
+            weekly_mood.append((week, round(mood, 1)))
+
+    columns = get_insight_columns(rollups)
+    return {
+        "weekly_mood": weekly_mood,
+        "events": columns.mood_by_label("Event")[:events],
+        # Fitbit sleep is dated by the wake-up day: it precedes that day's moods
+        "sleep": columns.mood_correlation("Sleep", lag_days=0),
+        "steps": columns.mood_correlation("Steps", lag_days=1),
+    }
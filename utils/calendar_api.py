@@ -1,11 +1,23 @@
 import os
 import datetime
+import threading
 from dateutil.parser import parse
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from googleapiclient.discovery import build
-from flask import request, session, redirect, url_for, flash
-from utils.storage import load_config
+from googleapiclient.errors import HttpError
+from flask import request, session, redirect, url_for, flash, has_request_context
+from utils.storage import (
+    get_config,
+    get_calendar_targets,
+    get_calendar_classifier,
+    load_json,
+    save_json,
+)
+from utils.tokens import load_tokens, save_tokens, get_fresh_tokens
+from utils.categories import get_category_classifier
 
 # Set OAUTHLIB_INSECURE_TRANSPORT for local development
 if os.getenv("APP_ENV", "local") == "local":
@@ -15,6 +27,17 @@ SCHEME = "http" if os.getenv("APP_ENV", "local") == "local" else "https"
 CALENDAR_CLIENT_ID = os.getenv("CALENDAR_CLIENT_ID")
 CALENDAR_CLIENT_SECRET = os.getenv("CALENDAR_CLIENT_SECRET")
 
+# Incremental sync: events are kept in a local cache next to the data file
+CALENDAR_SYNC = os.getenv("CALENDAR_SYNC", "false").lower() == "true"
+CALENDAR_CACHE_NAME = "calendar_cache.json"
+# Credentials, encrypted in the token store next to the data file
+CALENDAR_CREDENTIALS_NAME = "calendar_credentials.json"
+
+# Events per page, and fields requested for each page (a field mask keeps
+# payloads small)
+CALENDAR_PAGE_SIZE = int(os.getenv("CALENDAR_PAGE_SIZE", "250"))
+EVENT_FIELDS = "nextPageToken,nextSyncToken,items(id,status,summary,start,end)"
+
 
 # Create OAuth flow
 def create_flow(redirect_uri):
@@ -50,17 +73,8 @@ def calendar_callback():
         flow = create_flow(redirect_uri)
         flow.fetch_token(authorization_response=request.url)
 
-        # Store credentials in the session
-        credentials = flow.credentials
-        session["calendar_credentials"] = {
-            "token": credentials.token,
-            "refresh_token": credentials.refresh_token,
-            "token_uri": credentials.token_uri,
-            "client_id": credentials.client_id,
-            "client_secret": credentials.client_secret,
-            "scopes": credentials.scopes,
-            "expiry": credentials.expiry.isoformat() if credentials.expiry else None,
-        }
+        # Store credentials server-side, for every worker and background job
+        save_tokens(CALENDAR_CREDENTIALS_NAME, _credentials_info(flow.credentials))
         flash("Successfully connected to Google Calendar", "success")
         return redirect(url_for("dashboard"))
     except Exception as e:
@@ -68,15 +82,20 @@ def calendar_callback():
         return redirect(url_for("dashboard"))
 
 
-def get_credentials():
-    if "calendar_credentials" not in session:
-        return None
-
-    credentials_info = session["calendar_credentials"]
+def _credentials_info(credentials):
+    return {
+        "token": credentials.token,
+        "refresh_token": credentials.refresh_token,
+        "token_uri": credentials.token_uri,
+        "client_id": credentials.client_id,
+        "client_secret": credentials.client_secret,
+        "scopes": credentials.scopes,
+        "expiry": credentials.expiry.isoformat() if credentials.expiry else None,
+    }
 
-    if credentials_info.get("expiry") and isinstance(credentials_info["expiry"], str):
-        credentials_info["expiry"] = parse(credentials_info["expiry"])
 
+def _build_credentials(credentials_info):
+    expiry = credentials_info.get("expiry")
     return Credentials(
         token=credentials_info["token"],
         refresh_token=credentials_info["refresh_token"],
@@ -84,81 +103,272 @@ def get_credentials():
         client_id=credentials_info["client_id"],
         client_secret=credentials_info["client_secret"],
         scopes=credentials_info["scopes"],
-        expiry=credentials_info.get("expiry"),
+        expiry=parse(expiry) if expiry else None,
     )
 
 
-def get_calendar_events():
-    credentials = get_credentials()
-    if not credentials:
+def _credentials_expired(credentials_info):
+    # Refreshed a bit early, so that API calls never refresh them on their own
+    expiry = credentials_info.get("expiry")
+    refresh_time = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
+    return bool(expiry) and refresh_time >= parse(expiry)
+
+
+def _refresh_credentials(credentials_info):
+    credentials = _build_credentials(credentials_info)
+    try:
+        credentials.refresh(GoogleAuthRequest())
+    except RefreshError as e:
+        print(f"Error refreshing calendar credentials: {e}")
         return None
+    return _credentials_info(credentials)
 
-    service = build("calendar", "v3", credentials=credentials)
 
-    # Get the start and end dates for the current week
-    now = datetime.datetime.utcnow()
-    start_of_week = now - datetime.timedelta(days=now.weekday())
-    start_of_week = (
-        start_of_week.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
-        + "Z"
-    )
-    end_of_week = now + datetime.timedelta(days=6 - now.weekday())
-    end_of_week = (
-        end_of_week.replace(
-            hour=23, minute=59, second=59, microsecond=999999
-        ).isoformat()
-        + "Z"
+def get_credentials():
+    "Returns the stored credentials, refreshed if expired, or None if not connected"
+    if has_request_context() and "calendar_credentials" in session:
+        # Sessions from before the token store: moved out of the cookie
+        credentials_info = dict(session.pop("calendar_credentials"))
+        expiry = credentials_info.get("expiry")
+        if isinstance(expiry, datetime.datetime):
+            credentials_info["expiry"] = expiry.replace(tzinfo=None).isoformat()
+        if load_tokens(CALENDAR_CREDENTIALS_NAME) is None:
+            try:
+                save_tokens(CALENDAR_CREDENTIALS_NAME, credentials_info)
+            except ValueError as e:
+                print(f"Unable to move the calendar credentials: {e}")
+
+    credentials_info = get_fresh_tokens(
+        CALENDAR_CREDENTIALS_NAME, _credentials_expired, _refresh_credentials
     )
+    if not credentials_info:
+        return None
+    return _build_credentials(credentials_info)
 
-    try:
-        events_result = (
+
+# Calendar service of each thread, built again when the access token changes
+# (service objects are not thread-safe, and build() is expensive)
+_services = threading.local()
+
+
+def get_calendar_service(credentials):
+    key = (credentials.client_id, credentials.token)
+    if getattr(_services, "key", None) != key:
+        _services.service = build(
+            "calendar", "v3", credentials=credentials, cache_discovery=False
+        )
+        _services.key = key
+    return _services.service
+
+
+def iter_event_pages(service, max_results=None, fields=EVENT_FIELDS, **params):
+    "Yields every page of an events list request, following nextPageToken"
+    page_token = None
+    while True:
+        page = (
             service.events()
             .list(
                 calendarId="primary",
-                timeMin=start_of_week,
-                timeMax=end_of_week,
-                singleEvents=True,
-                orderBy="startTime",
+                pageToken=page_token,
+                maxResults=max_results or CALENDAR_PAGE_SIZE,
+                fields=fields,
+                **params,
             )
             .execute()
         )
+        yield page
+        page_token = page.get("nextPageToken")
+        if not page_token:
+            return
+
+
+def iter_events(service, time_min, time_max, max_results=None, fields=EVENT_FIELDS):
+    "Yields the events of a time range in start order, one page at a time"
+    for page in iter_event_pages(
+        service,
+        max_results=max_results,
+        fields=fields,
+        timeMin=time_min,
+        timeMax=time_max,
+        singleEvents=True,
+        orderBy="startTime",
+    ):
+        yield from page.get("items", [])
+
+
+def get_event_bounds(event):
+    "Returns the start and end of an event as strings, and as aware datetimes"
+    start = event.get("start", {}).get("dateTime", event.get("start", {}).get("date"))
+    end = event.get("end", {}).get("dateTime", event.get("end", {}).get("date"))
+    start_dt = parse(start)
+    end_dt = parse(end)
+    if start_dt.tzinfo is None:
+        start_dt = start_dt.replace(tzinfo=datetime.timezone.utc)
+    if end_dt.tzinfo is None:
+        end_dt = end_dt.replace(tzinfo=datetime.timezone.utc)
+    return start, end, start_dt, end_dt
+
+
+def collect_events(events, time_min, time_max, collected):
+    """
+    Passes events through, appending those overlapping a time range (as the
+    Calendar API does) to the collected list.
+    """
+    time_min, time_max = parse(time_min), parse(time_max)
+    for event in events:
+        _, _, start_dt, end_dt = get_event_bounds(event)
+        if start_dt < time_max and end_dt > time_min:
+            collected.append(event)
+        yield event
+
+
+def format_events(events):
+    formatted_events = []
+    for event in events:
+        start = event.get("start", {}).get(
+            "dateTime", event.get("start", {}).get("date")
+        )
+        end = event.get("end", {}).get("dateTime", event.get("end", {}).get("date"))
+
+        # Format dates
+        if "T" in start:  # This is a dateTime
+            start_dt = parse(start)
+            end_dt = parse(end)
+            duration = (end_dt - start_dt).total_seconds() / 3600  # Hours
+            start_formatted = start_dt.strftime("%Y-%m-%d %H:%M")
+        else:  # This is a date (all-day event)
+            start_dt = parse(start)
+            start_formatted = start_dt.strftime("%Y-%m-%d (all day)")
+            duration = 24  # All day
+
+        formatted_events.append(
+            {
+                "title": event.get("summary", "(No title)"),
+                "start": start_formatted,
+                "duration": duration,
+                "raw_start": start,  # Keep the raw date for sorting
+            }
+        )
 
-        events = events_result.get("items", [])
+    # Sort events by start time
+    formatted_events.sort(key=lambda x: x["raw_start"])
 
-        formatted_events = []
-        for event in events:
-            start = event.get("start", {}).get(
-                "dateTime", event.get("start", {}).get("date")
-            )
-            end = event.get("end", {}).get("dateTime", event.get("end", {}).get("date"))
-
-            # Format dates
-            if "T" in start:  # This is a dateTime
-                start_dt = parse(start)
-                end_dt = parse(end)
-                duration = (end_dt - start_dt).total_seconds() / 3600  # Hours
-                start_formatted = start_dt.strftime("%Y-%m-%d %H:%M")
-            else:  # This is a date (all-day event)
-                start_dt = parse(start)
-                start_formatted = start_dt.strftime("%Y-%m-%d (all day)")
-                duration = 24  # All day
-
-            formatted_events.append(
-                {
-                    "title": event.get("summary", "(No title)"),
-                    "start": start_formatted,
-                    "duration": duration,
-                    "raw_start": start,  # Keep the raw date for sorting
-                }
-            )
+    return formatted_events
+
+
+def sync_calendar_events(service):
+    """
+    Updates the local event cache with the changes since the last sync.
+
+    The first sync lists every event; later ones only fetch changes using the
+    sync token returned by the previous one. Returns the cached events by id.
+    """
+    cache = load_json(CALENDAR_CACHE_NAME) or {}
+    events = dict(cache.get("events", {}))
+    sync_token = cache.get("sync_token")
+
+    params = {"singleEvents": True}
+    changed = not sync_token
+    if sync_token:
+        params["syncToken"] = sync_token
+    while True:
+        try:
+            for page in iter_event_pages(service, max_results=2500, **params):
+                for event in page.get("items", []):
+                    changed = True
+                    if event.get("status") == "cancelled":
+                        events.pop(event["id"], None)
+                        continue
+                    cached_event = {
+                        key: event[key]
+                        for key in ("id", "summary", "start", "end")
+                        if key in event
+                    }
+                    # Timestamps of the bounds, to filter and sort without parsing
+                    _, _, start_dt, end_dt = get_event_bounds(event)
+                    cached_event["bounds"] = [
+                        start_dt.timestamp(),
+                        end_dt.timestamp(),
+                    ]
+                    events[event["id"]] = cached_event
+                # The last page holds the token for the next sync
+                sync_token = page.get("nextSyncToken")
+            break
+        except HttpError as e:
+            if e.resp.status == 410 and "syncToken" in params:
+                # Sync token expired: start over with a full sync
+                events, changed = {}, True
+                params.pop("syncToken")
+                continue
+            raise
+
+    if changed:
+        save_json(
+            CALENDAR_CACHE_NAME,
+            {"sync_token": sync_token, "events": events},
+        )
+    return events
+
+
+def load_cached_events(time_min=None, time_max=None):
+    """
+    Returns the events of the local cache overlapping a time range (ISO strings),
+    sorted by start time. Used to compute summaries without calling the API.
+    """
+    cache = load_json(CALENDAR_CACHE_NAME) or {}
+    events = list(cache.get("events", {}).values())
+    if time_min and time_max:
+        min_ts, max_ts = parse(time_min).timestamp(), parse(time_max).timestamp()
+        events = [
+            event
+            for event in events
+            if event["bounds"][0] < max_ts and event["bounds"][1] > min_ts
+        ]
+    events.sort(key=lambda event: event["bounds"][0])
+    return events
+
+
+def get_calendar_data(cached=False):
+    """
+    Gets the current week's events and the weekly summary by category.
 
-        # Sort events by start time
-        formatted_events.sort(key=lambda x: x["raw_start"])
+    Both come from a single list request covering the previous and current weeks,
+    or only from the local event cache if cached is set. Returns (events,
+    weekly_summary), or (None, None) if the calendar is not connected or cannot
+    be reached.
+    """
+    if cached:
+        # The cache is read without calling Google, not even to refresh tokens
+        if load_tokens(CALENDAR_CREDENTIALS_NAME) is None:
+            return None, None
+    else:
+        credentials = get_credentials()
+        if not credentials:
+            return None, None
+
+    prev_week_start, _ = get_week_time_range(weeks_ago=1)
+    curr_week_start, curr_week_end = get_week_time_range(weeks_ago=0)
 
-        return formatted_events
+    try:
+        if cached:
+            events = load_cached_events(prev_week_start, curr_week_end)
+        elif CALENDAR_SYNC:
+            service = get_calendar_service(credentials)
+            sync_calendar_events(service)
+            events = load_cached_events(prev_week_start, curr_week_end)
+        else:
+            service = get_calendar_service(credentials)
+            events = iter_events(service, prev_week_start, curr_week_end)
+        # Events are summarized as pages arrive, only the current week is kept
+        curr_week_events = []
+        weekly_summary = get_weekly_summary(
+            collect_events(events, curr_week_start, curr_week_end, curr_week_events)
+        )
     except Exception as e:
         print(f"Error fetching calendar events: {e}")
-        return None
+        return None, None
+
+    return format_events(curr_week_events), weekly_summary
 
 
 def get_week_time_range(weeks_ago=0):
@@ -179,183 +389,132 @@ def get_week_time_range(weeks_ago=0):
     return start_of_week.isoformat() + "Z", end_of_week.isoformat() + "Z"
 
 
-def get_events_summary(
-    service, time_min, time_max, config_categories, current_time=None
-):
+class EventsSummary:
     """
-    Process calendar events for a given time period and return category summaries.
-    Only considers events that are at least 1 hour long.
-    """
-    try:
-        events_result = (
-            service.events()
-            .list(
-                calendarId="primary",
-                timeMin=time_min,
-                timeMax=time_max,
-                singleEvents=True,
-                orderBy="startTime",
-            )
-            .execute()
-        )
+    Category summary of calendar events for a given time period.
 
-        events = events_result.get("items", [])
+    Events are added one at a time, so that pages can be aggregated as they are
+    fetched. Only considers events that are at least 1 hour long.
+    """
 
-        # If no events found, return empty summary
-        if not events:
-            return {
-                "categories": {
-                    category: {"completed": 0, "scheduled": 0, "total": 0}
-                    for category in config_categories.keys()
-                },
-                "events_by_category": {
-                    category: [] for category in config_categories.keys()
-                },
-                "total": {"completed": 0, "scheduled": 0, "total": 0},
-            }
+    def __init__(
+        self, time_min, time_max, config_categories, current_time=None, classifier=None
+    ):
+        self.time_min = parse(time_min)
+        self.time_max = parse(time_max)
+        self.config_categories = config_categories
+        self.classifier = classifier or get_category_classifier(config_categories)
+        self.current_time_utc = None
+        if current_time:
+            self.current_time_utc = current_time.replace(tzinfo=datetime.timezone.utc)
+        self.event_count = 0
 
         # Initialize hours for each category
-        summary = {
+        self.summary = {
             category: {"completed": 0, "scheduled": 0, "total": 0}
             for category in config_categories.keys()
         }
-        summary["Other"] = {"completed": 0, "scheduled": 0, "total": 0}
+        self.summary["Other"] = {"completed": 0, "scheduled": 0, "total": 0}
 
         # Track events by category
-        events_by_category = {category: [] for category in config_categories.keys()}
-        events_by_category["Other"] = []
+        self.events_by_category = {
+            category: [] for category in config_categories.keys()
+        }
+        self.events_by_category["Other"] = []
 
-        # Totals for all categories excluding "Other"
-        total_summary = {"completed": 0, "scheduled": 0, "total": 0}
+    def add(self, event, bounds=None):
+        start, _, start_dt, end_dt = bounds or get_event_bounds(event)
 
-        # Count hours for each category
-        for event in events:
-            start = event.get("start", {}).get(
-                "dateTime", event.get("start", {}).get("date")
-            )
-            end = event.get("end", {}).get("dateTime", event.get("end", {}).get("date"))
-            title = event.get("summary", "")
+        # Skip events outside of the time period
+        if not (start_dt < self.time_max and end_dt > self.time_min):
+            return
+        self.event_count += 1
 
-            # Skip all-day events
-            if "T" not in start:
-                continue
+        # Skip all-day events
+        if "T" not in start:
+            return
 
-            # Calculate event duration
-            start_dt = parse(start)
-            end_dt = parse(end)
+        # Calculate event duration
+        duration = (end_dt - start_dt).total_seconds() / 3600  # Hours
 
-            # Make sure datetime objects are timezone-aware for comparison
-            if end_dt.tzinfo is None:
-                end_dt = end_dt.replace(tzinfo=datetime.timezone.utc)
-            if start_dt.tzinfo is None:
-                start_dt = start_dt.replace(tzinfo=datetime.timezone.utc)
+        # Skip events shorter than 1 hour
+        if duration < 1:
+            return
 
-            duration = (end_dt - start_dt).total_seconds() / 3600  # Hours
+        # Determine if the event is completed
+        is_completed = False
+        if self.current_time_utc:
+            is_completed = end_dt <= self.current_time_utc
 
-            # Skip events shorter than 1 hour
-            if duration < 1:
-                continue
+        # Assign to category based on keywords from config
+        title = event.get("summary", "")
+        category = self.classifier.classify(title)
 
-            # Determine if the event is completed
-            is_completed = False
-            if current_time:
-                current_time_utc = current_time.replace(tzinfo=datetime.timezone.utc)
-                is_completed = end_dt <= current_time_utc
-
-            # Assign to category based on keywords from config
-            category_found = False
-            for category, category_data in config_categories.items():
-                keywords = category_data.get("keywords", [])
-                if any(keyword.lower() in title.lower() for keyword in keywords):
-                    # Add to total hours for all events
-                    summary[category]["total"] += duration
-
-                    # Now "scheduled" means all events of the week (no longer future events)
-                    summary[category]["scheduled"] += duration
-
-                    # "completed" remains only completed events
-                    if is_completed:
-                        summary[category]["completed"] += duration
-
-                    # Add to events list for this category
-                    events_by_category[category].append(
-                        {
-                            "title": title,
-                            "start": start_dt.strftime("%A")
-                            if "T" in start
-                            else start_dt.strftime("%A (all day)"),
-                            "duration": duration,
-                            "is_completed": is_completed,
-                        }
-                    )
-
-                    category_found = True
-                    break
-
-            if not category_found:
-                summary["Other"]["total"] += duration
-                summary["Other"]["scheduled"] += duration
-                if is_completed:
-                    summary["Other"]["completed"] += duration
-
-                events_by_category["Other"].append(
-                    {
-                        "title": title,
-                        "start": start_dt.strftime("%A")
-                        if "T" in start
-                        else start_dt.strftime("%A (all day)"),
-                        "duration": duration,
-                        "is_completed": is_completed,
-                    }
-                )
+        # Add to total hours for all events
+        self.summary[category]["total"] += duration
+
+        # Now "scheduled" means all events of the week (no longer future events)
+        self.summary[category]["scheduled"] += duration
+
+        # "completed" remains only completed events
+        if is_completed:
+            self.summary[category]["completed"] += duration
+
+        # Add to events list for this category
+        self.events_by_category[category].append(
+            {
+                "title": title,
+                "start": start_dt.strftime("%A"),
+                "duration": duration,
+                "is_completed": is_completed,
+            }
+        )
+
+    def result(self):
+        # If no events found, return empty summary
+        if not self.event_count:
+            return empty_events_summary(self.config_categories)
 
-        # Calculate totals for all categories excluding "Other"
-        for category, data in summary.items():
+        # Totals for all categories excluding "Other"
+        total_summary = {"completed": 0, "scheduled": 0, "total": 0}
+        for category, data in self.summary.items():
             if category != "Other":
                 total_summary["total"] += data["total"]
                 total_summary["completed"] += data["completed"]
                 total_summary["scheduled"] += data["scheduled"]
 
         return {
-            "categories": summary,
-            "events_by_category": events_by_category,
+            "categories": self.summary,
+            "events_by_category": self.events_by_category,
             "total": total_summary,
         }
-    except Exception as e:
-        print(f"Error processing events: {e}")
-        # Return empty summaries
-        return {
-            "categories": {
-                category: {"completed": 0, "scheduled": 0, "total": 0}
-                for category in config_categories.keys()
-            },
-            "events_by_category": {
-                category: [] for category in config_categories.keys()
-            },
-            "total": {"completed": 0, "scheduled": 0, "total": 0},
-        }
 
 
-def get_weekly_summary(service):
+def empty_events_summary(config_categories):
+    return {
+        "categories": {
+            category: {"completed": 0, "scheduled": 0, "total": 0}
+            for category in config_categories.keys()
+        },
+        "events_by_category": {category: [] for category in config_categories.keys()},
+        "total": {"completed": 0, "scheduled": 0, "total": 0},
+    }
+
+
+def get_weekly_summary(events):
     """
     Gets a summary of calendar events for the current and previous week, grouped by category.
 
     Args:
-        service: Google Calendar API service instance.
+        events: Iterable of calendar events covering the previous and current weeks.
 
     Returns:
         Dictionary with event categories as keys and hours as values, or None if error.
     """
-    # Load categories from config
-    config_path = os.getenv("CONFIG_PATH", "config.json")
-    config = load_config(config_path)
-    config_categories = config.get("calendar_events", {})
-
-    # Extract targets from config
-    target_hours = {
-        category: data.get("target", 0) for category, data in config_categories.items()
-    }
-    target_hours["Other"] = 0
+    # Load categories, targets and classifier from config
+    config_categories = get_config().get("calendar_events", {})
+    target_hours = get_calendar_targets()
+    classifier = get_calendar_classifier()
 
     # Get current time for determining completed events
     current_time = datetime.datetime.utcnow()
@@ -366,15 +525,20 @@ def get_weekly_summary(service):
     # Get last week time range
     prev_week_start, prev_week_end = get_week_time_range(weeks_ago=1)
 
-    # Get summaries for current week
-    curr_week_summary = get_events_summary(
-        service, curr_week_start, curr_week_end, config_categories, current_time
+    # Get summaries for both weeks in a single pass over the events
+    # (all events of the previous week are completed)
+    curr_week_aggregate = EventsSummary(
+        curr_week_start, curr_week_end, config_categories, current_time, classifier
     )
-
-    # Get summaries for previous week (all events are completed)
-    prev_week_summary = get_events_summary(
-        service, prev_week_start, prev_week_end, config_categories
+    prev_week_aggregate = EventsSummary(
+        prev_week_start, prev_week_end, config_categories, classifier=classifier
     )
+    for event in events:
+        bounds = get_event_bounds(event)
+        curr_week_aggregate.add(event, bounds)
+        prev_week_aggregate.add(event, bounds)
+    curr_week_summary = curr_week_aggregate.result()
+    prev_week_summary = prev_week_aggregate.result()
 
     # Calculate total target hours (excluding "Other")
     total_target = sum(
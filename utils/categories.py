@@ -0,0 +1,58 @@
+import re
+from functools import lru_cache
+
+
+class CategoryClassifier:
+    """
+    Assigns event titles to the first configured category having a keyword
+    contained in the title (case-insensitive), or to the default category.
+
+    All keywords are compiled into a single alternation, in config order, inside
+    a lookahead so that overlapping matches are all found. At each position the
+    regex engine returns the first matching keyword, i.e. the one of the lowest
+    category, and the lowest category over all positions wins.
+    """
+
+    def __init__(self, categories, default="Other"):
+        self.default = default
+        self.categories = []
+        self.keyword_categories = {}
+        for index, (category, keywords) in enumerate(categories):
+            self.categories.append(category)
+            for keyword in keywords:
+                self.keyword_categories.setdefault(keyword.lower(), index)
+        alternatives = "|".join(re.escape(k) for k in self.keyword_categories)
+        self.pattern = None
+        if self.keyword_categories:
+            self.pattern = re.compile(f"(?=({alternatives}))", re.DOTALL)
+
+    def classify(self, title):
+        if self.pattern is None:
+            return self.default
+        best = None
+        for match in self.pattern.finditer(title.lower()):
+            index = self.keyword_categories[match.group(1)]
+            if best is None or index < best:
+                best = index
+                if best == 0:
+                    break
+        if best is None:
+            return self.default
+        return self.categories[best]
+
+    def classify_many(self, titles):
+        return [self.classify(title) for title in titles]
+
+
+@lru_cache(maxsize=8)
+def _build_classifier(categories):
+    return CategoryClassifier(categories)
+
+
+def get_category_classifier(config_categories):
+    "Returns the classifier for the calendar categories of a config, built once"
+    categories = tuple(
+        (category, tuple(data.get("keywords", [])))
+        for category, data in config_categories.items()
+    )
+    return _build_classifier(categories)
@@ -1,16 +1,161 @@
 import os
+import time
+import random
+import threading
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from datetime import datetime, timedelta
-from flask import request, session, redirect, url_for
+from flask import request, session, redirect, url_for, has_request_context
 from urllib.parse import urlencode
 
-from utils.storage import load_data, save_data
+from utils.storage import load_data_by_date, save_rows, load_json, save_json
+from utils.tokens import load_tokens, save_tokens, get_fresh_tokens
+from utils.intraday import SERIES, MINUTES_PER_DAY, save_day, has_day
 
 SCHEME = "http" if os.getenv("APP_ENV", "local") == "local" else "https"
 FITBIT_CLIENT_ID = os.getenv("FITBIT_CLIENT_ID")
 FITBIT_CLIENT_SECRET = os.getenv("FITBIT_CLIENT_SECRET")
 
+# Documents stored next to the data file (tokens are encrypted)
+FITBIT_TOKENS_NAME = "fitbit_tokens.json"
+FITBIT_TODAY_NAME = "fitbit_today.json"
+
+# Longest date range accepted by the sleep time series endpoint
+FITBIT_MAX_RANGE_DAYS = 100
+# Requests kept in reserve in the hourly rate limit (150) when backfilling
+FITBIT_MIN_REMAINING_REQUESTS = 10
+# Seconds to connect to and to wait for Fitbit on each call
+FITBIT_CONNECT_TIMEOUT = float(os.getenv("FITBIT_CONNECT_TIMEOUT", "3.05"))
+FITBIT_READ_TIMEOUT = float(os.getenv("FITBIT_READ_TIMEOUT", "10"))
+# Retries of failed calls, and longest wait before one (longer waits give up)
+FITBIT_MAX_RETRIES = 2
+FITBIT_MAX_RETRY_WAIT = 10
+# Heart rate per minute, steps per 15 minutes and weight are also ingested
+FITBIT_INTRADAY = os.getenv("FITBIT_INTRADAY", "false").lower() == "true"
+# Longest date range accepted by the weight log endpoint
+FITBIT_MAX_WEIGHT_RANGE_DAYS = 31
+# Seconds before the data of the current day is fetched again
+FITBIT_CACHE_TTL = float(os.getenv("FITBIT_CACHE_TTL", "300"))
+
+# Daily values fetched from Fitbit: (user, date, resource) -> (fetch time, value)
+_fitbit_cache = {}
+_fitbit_cache_lock = threading.Lock()
+# Keys being refreshed in the background, refreshed once at a time
+_refreshing = set()
+_refresh_executor = ThreadPoolExecutor(max_workers=2)
+
+# Connections to Fitbit are pooled and kept alive across calls and threads
+_http = requests.Session()
+_http.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=10))
+
+# Call counters and latencies, for monitoring
+_stats = {
+    "calls": 0,
+    "retries": 0,
+    "errors": 0,
+    "rate_limited": 0,
+    "statuses": {},
+    "latency_total": 0.0,
+    "latency_max": 0.0,
+    "rate_limit_remaining": None,
+}
+_latencies = deque(maxlen=200)
+_stats_lock = threading.Lock()
+# Monotonic time until which Fitbit refuses calls (429), 0 if not limited
+_rate_limited_until = 0
+
+
+def _record_call(status, latency):
+    with _stats_lock:
+        _stats["calls"] += 1
+        status = str(status)
+        _stats["statuses"][status] = _stats["statuses"].get(status, 0) + 1
+        _stats["latency_total"] += latency
+        _stats["latency_max"] = max(_stats["latency_max"], latency)
+        _latencies.append(latency)
+
+
+def _count(counter):
+    with _stats_lock:
+        _stats[counter] += 1
+
+
+def _retry_after(response):
+    "Returns the seconds to wait before calling Fitbit again after a 429"
+    for header in ("Retry-After", "fitbit-rate-limit-reset"):
+        try:
+            return float(response.headers[header])
+        except (KeyError, ValueError):
+            continue
+    return 60
+
+
+def _fitbit_request(method, url, **kwargs):
+    """
+    Calls the Fitbit API through the pooled session, with timeouts.
+
+    Connection errors and 5xx responses of GET calls are retried with backoff.
+    A 429 is retried after its Retry-After delay if short enough, otherwise
+    the response is returned, and further calls fail fast until the limit is
+    reset. Token refreshes (POST) are only retried on 429, as a failed one may
+    have used the refresh token.
+    """
+    global _rate_limited_until
+    wait_left = _rate_limited_until - time.monotonic()
+    if wait_left > 0:
+        _count("rate_limited")
+        raise ConnectionError(f"Fitbit rate limit reached, retry in {wait_left:.0f}s")
+
+    for attempt in range(FITBIT_MAX_RETRIES + 1):
+        retry = attempt < FITBIT_MAX_RETRIES
+        started = time.monotonic()
+        try:
+            response = _http.request(
+                method,
+                url,
+                timeout=(FITBIT_CONNECT_TIMEOUT, FITBIT_READ_TIMEOUT),
+                **kwargs,
+            )
+        except requests.RequestException:
+            _record_call("error", time.monotonic() - started)
+            _count("errors")
+            if not retry or method != "GET":
+                raise
+            wait = random.uniform(0, 0.5 * 2**attempt)
+        else:
+            _record_call(response.status_code, time.monotonic() - started)
+            remaining = response.headers.get("fitbit-rate-limit-remaining")
+            if remaining is not None:
+                with _stats_lock:
+                    _stats["rate_limit_remaining"] = int(remaining)
+            if response.status_code == 429:
+                _count("rate_limited")
+                wait = _retry_after(response)
+                if not retry or wait > FITBIT_MAX_RETRY_WAIT:
+                    _rate_limited_until = time.monotonic() + wait
+                    return response
+            elif response.status_code >= 500 and method == "GET" and retry:
+                wait = random.uniform(0, 0.5 * 2**attempt)
+            else:
+                return response
+        _count("retries")
+        time.sleep(wait)
+
+
+def get_fitbit_stats():
+    "Returns the counters and latencies (seconds) of the Fitbit calls"
+    with _stats_lock:
+        stats = dict(_stats, statuses=dict(_stats["statuses"]))
+        latencies = sorted(_latencies)
+    stats["latency_avg"] = (
+        stats["latency_total"] / stats["calls"] if stats["calls"] else None
+    )
+    stats["latency_p95"] = latencies[int(len(latencies) * 0.95)] if latencies else None
+    return stats
+
 
 def fitbit_login():
     redirect_uri = url_for("fitbit_callback", _external=True, _scheme=SCHEME)
@@ -41,7 +186,9 @@ def fitbit_callback():
     }
     auth_header = HTTPBasicAuth(FITBIT_CLIENT_ID, FITBIT_CLIENT_SECRET)
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    response = requests.post(token_url, data=data, auth=auth_header, headers=headers)
+    response = _fitbit_request(
+        "POST", token_url, data=data, auth=auth_header, headers=headers
+    )
     token_info = response.json()
 
     if response.status_code != 200:
@@ -50,20 +197,61 @@ def fitbit_callback():
         ]
         return f"Error: {error_message}"
 
-    # Save tokens in session
-    session["fitbit_access_token"] = token_info["access_token"]
-    session["fitbit_refresh_token"] = token_info["refresh_token"]
-    session["fitbit_expires_at"] = (
-        datetime.utcnow() + timedelta(seconds=token_info["expires_in"])
-    ).isoformat()
-
+    try:
+        _save_tokens(token_info)
+    except ValueError as e:
+        return f"Error: {e}"
     return redirect(url_for("home"))
 
 
-def refresh_fitbit_token():
-    refresh_token = session.get("fitbit_refresh_token")
+def _parse_tokens(token_info):
+    return {
+        "access_token": token_info["access_token"],
+        "refresh_token": token_info["refresh_token"],
+        "user_id": token_info.get("user_id"),
+        "expires_at": (
+            datetime.utcnow() + timedelta(seconds=token_info["expires_in"])
+        ).isoformat(),
+    }
+
+
+def _save_tokens(token_info):
+    "Keeps new tokens in the server-side token store"
+    save_tokens(FITBIT_TOKENS_NAME, _parse_tokens(token_info))
+
+
+def _load_tokens():
+    "Returns the stored tokens, or None if Fitbit is not connected"
+    tokens = load_tokens(FITBIT_TOKENS_NAME)
+    if has_request_context() and "fitbit_access_token" in session:
+        # Sessions from before the token store: tokens are moved out of the cookie
+        session_tokens = {
+            key: session.pop(f"fitbit_{key}", None)
+            for key in ("access_token", "refresh_token", "expires_at")
+        }
+        if tokens is None:
+            try:
+                save_tokens(FITBIT_TOKENS_NAME, session_tokens)
+                tokens = session_tokens
+            except ValueError as e:
+                print(f"Unable to move the Fitbit tokens: {e}")
+    return tokens
+
+
+def has_fitbit_tokens():
+    return _load_tokens() is not None
+
+
+def _tokens_expired(tokens):
+    expires_at = tokens.get("expires_at")
+    return not expires_at or datetime.utcnow() >= datetime.fromisoformat(expires_at)
+
+
+def refresh_fitbit_token(tokens):
+    "Returns new tokens obtained with the refresh token, or None if it failed"
+    refresh_token = tokens.get("refresh_token")
     if not refresh_token:
-        return False
+        return None
 
     token_url = "https://api.fitbit.com/oauth2/token"
     data = {
@@ -72,82 +260,325 @@ def refresh_fitbit_token():
     }
     auth_header = HTTPBasicAuth(FITBIT_CLIENT_ID, FITBIT_CLIENT_SECRET)
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    response = requests.post(token_url, data=data, auth=auth_header, headers=headers)
+    response = _fitbit_request(
+        "POST", token_url, data=data, auth=auth_header, headers=headers
+    )
     token_info = response.json()
 
     if response.status_code != 200:
-        return False
+        return None
 
-    # Update tokens in session
-    session["fitbit_access_token"] = token_info["access_token"]
-    session["fitbit_refresh_token"] = token_info["refresh_token"]
-    session["fitbit_expires_at"] = (
-        datetime.utcnow() + timedelta(seconds=token_info["expires_in"])
-    ).isoformat()
-    return True
+    return _parse_tokens(token_info)
 
 
-def get_fitbit_data(date):
-    access_token = session.get("fitbit_access_token")
-    if not access_token:
+def get_access_token():
+    tokens = _load_tokens()
+    if tokens is None:
         raise ValueError("Fitbit connection is required.")
 
-    expires_at_str = session.get("fitbit_expires_at")
-    if expires_at_str:
-        expires_at = datetime.fromisoformat(expires_at_str)
-    else:
-        expires_at = datetime.utcnow()
-
-    if datetime.utcnow() >= expires_at:
-        if not refresh_fitbit_token():
+    if _tokens_expired(tokens):
+        # Refreshed once for all workers and background jobs
+        tokens = get_fresh_tokens(
+            FITBIT_TOKENS_NAME, _tokens_expired, refresh_fitbit_token
+        )
+        if tokens is None:
             raise ValueError("Unable to refresh access token.")
-        access_token = session.get("fitbit_access_token")
+    return tokens["access_token"]
+
 
+def _fetch_fitbit_resource(access_token, date, resource):
+    "Fetches the steps or the sleep hours of a day"
     headers = {"Authorization": f"Bearer {access_token}"}
 
-    # Get steps data
-    activity_url = f"https://api.fitbit.com/1/user/-/activities/date/{date}.json"
-    activity_response = requests.get(activity_url, headers=headers)
-    if activity_response.status_code != 200:
-        raise ConnectionError(
-            f"Activity API Error: {activity_response.status_code} {activity_response.text}"
-        )
-    steps = activity_response.json().get("summary", {}).get("steps", 0)
+    if resource == "steps":
+        activity_url = f"https://api.fitbit.com/1/user/-/activities/date/{date}.json"
+        activity_response = _fitbit_request("GET", activity_url, headers=headers)
+        if activity_response.status_code != 200:
+            raise ConnectionError(
+                f"Activity API Error: {activity_response.status_code} {activity_response.text}"
+            )
+        return activity_response.json().get("summary", {}).get("steps", 0)
 
-    # Get sleep data
     sleep_url = f"https://api.fitbit.com/1.2/user/-/sleep/date/{date}.json"
-    sleep_response = requests.get(sleep_url, headers=headers)
+    sleep_response = _fitbit_request("GET", sleep_url, headers=headers)
     if sleep_response.status_code != 200:
         raise ConnectionError(
             f"Sleep API Error: {sleep_response.status_code} {sleep_response.text}"
         )
     sleep_data = sleep_response.json()
     total_minutes_asleep = sleep_data.get("summary", {}).get("totalMinutesAsleep", 0)
-    sleep_hours = total_minutes_asleep / 60
+    return total_minutes_asleep / 60
+
+
+def _is_past_day(date):
+    "Whether a day (YYYY-MM-DD) is over in every timezone"
+    return date < (datetime.utcnow() - timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def _load_saved_day(date):
+    "Returns the steps and sleep hours saved for a day, or None if not saved"
+    saved = {row.type: row.value for row in load_data_by_date(date)}
+    try:
+        return int(float(saved["Steps"])), float(saved["Sleep"])
+    except (KeyError, ValueError):
+        return None
+
+
+def _refresh_cached(key, access_token):
+    try:
+        value = _fetch_fitbit_resource(access_token, key[1], key[2])
+        with _fitbit_cache_lock:
+            _fitbit_cache[key] = (time.monotonic(), value)
+    except Exception as e:
+        print(f"Error refreshing Fitbit {key[2]} of {key[1]}: {e}")
+    finally:
+        with _fitbit_cache_lock:
+            _refreshing.discard(key)
+
+
+def _get_cached(user, access_token, date, resource, fresh=False):
+    """
+    Returns a cached value, fetched if missing or if fresh is set. Values of
+    past days are kept, those of the current day are refreshed in the
+    background once older than FITBIT_CACHE_TTL, the stale value being
+    returned meanwhile.
+    """
+    key = (user, date, resource)
+    with _fitbit_cache_lock:
+        entry = None if fresh else _fitbit_cache.get(key)
+        if entry is not None:
+            fetched_at, value = entry
+            expired = time.monotonic() - fetched_at >= FITBIT_CACHE_TTL
+            if expired and not _is_past_day(date) and key not in _refreshing:
+                _refreshing.add(key)
+                _refresh_executor.submit(_refresh_cached, key, access_token)
+            return value
+
+    value = _fetch_fitbit_resource(access_token, date, resource)
+    with _fitbit_cache_lock:
+        _fitbit_cache[key] = (time.monotonic(), value)
+    return value
+
+
+def get_fitbit_data(date, fresh=False):
+    "Returns the steps and sleep hours of a day, from storage or cached Fitbit calls"
+    if _is_past_day(date):
+        saved = _load_saved_day(date)
+        if saved is not None:
+            return saved
 
+    # The token is checked (and refreshed) here, background refreshes reuse it
+    access_token = get_access_token()
+    user = _load_tokens().get("user_id") or access_token
+    steps = _get_cached(user, access_token, date, "steps", fresh)
+    sleep_hours = _get_cached(user, access_token, date, "sleep", fresh)
     return steps, sleep_hours
 
 
+def save_fitbit_today(timezone):
+    "Fetches the steps and sleep of the current day, and saves them for the dashboard"
+    today = datetime.now(timezone).strftime("%Y-%m-%d")
+    steps, sleep_hours = get_fitbit_data(today, fresh=True)
+    save_json(FITBIT_TODAY_NAME, {"date": today, "steps": steps, "sleep": sleep_hours})
+    if FITBIT_INTRADAY:
+        data, _ = get_intraday_data(today)
+        for series, values in data.items():
+            save_day(series, today, values)
+
+
+def load_fitbit_today(today):
+    "Returns the steps and sleep hours last saved for a day, or (None, None)"
+    data = load_json(FITBIT_TODAY_NAME)
+    if not data or data.get("date") != today:
+        return None, None
+    return data["steps"], data["sleep"]
+
+
+def get_fitbit_range(start_date, end_date):
+    """
+    Gets daily steps and sleep hours between two dates (YYYY-MM-DD, inclusive)
+    with one call to each time series endpoint.
+
+    The range must not exceed FITBIT_MAX_RANGE_DAYS. Returns a dictionary
+    mapping each date to a (steps, sleep_hours) tuple, and the number of
+    requests left in the current rate limit window (None if unknown).
+    """
+    access_token = get_access_token()
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    # Get steps time series
+    steps_url = f"https://api.fitbit.com/1/user/-/activities/steps/date/{start_date}/{end_date}.json"
+    steps_response = _fitbit_request("GET", steps_url, headers=headers)
+    if steps_response.status_code != 200:
+        raise ConnectionError(
+            f"Activity API Error: {steps_response.status_code} {steps_response.text}"
+        )
+    steps = {
+        entry["dateTime"]: int(float(entry["value"]))
+        for entry in steps_response.json().get("activities-steps", [])
+    }
+
+    # Get sleep logs, summed by date like the daily summary does
+    sleep_url = (
+        f"https://api.fitbit.com/1.2/user/-/sleep/date/{start_date}/{end_date}.json"
+    )
+    sleep_response = _fitbit_request("GET", sleep_url, headers=headers)
+    if sleep_response.status_code != 200:
+        raise ConnectionError(
+            f"Sleep API Error: {sleep_response.status_code} {sleep_response.text}"
+        )
+    minutes_asleep = {}
+    for log in sleep_response.json().get("sleep", []):
+        date = log["dateOfSleep"]
+        minutes_asleep[date] = minutes_asleep.get(date, 0) + log.get("minutesAsleep", 0)
+
+    data = {}
+    date = datetime.strptime(start_date, "%Y-%m-%d")
+    while date <= datetime.strptime(end_date, "%Y-%m-%d"):
+        day = date.strftime("%Y-%m-%d")
+        data[day] = (steps.get(day, 0), minutes_asleep.get(day, 0) / 60)
+        date += timedelta(days=1)
+
+    remaining = sleep_response.headers.get("fitbit-rate-limit-remaining")
+    return data, int(remaining) if remaining is not None else None
+
+
+def backfill_fitbit_data(start_date, end_date):
+    """
+    Saves Fitbit data missing between two dates (YYYY-MM-DD, inclusive).
+
+    The range is fetched in chunks of FITBIT_MAX_RANGE_DAYS, two requests each,
+    and the backfill stops early when the rate limit is close to being reached.
+    Days still missing are picked up by the next backfill.
+    """
+    fitbit_types = ["Sleep", "Steps"]
+
+    # Days missing at least one of the Fitbit types
+    missing_dates = []
+    date = datetime.strptime(start_date, "%Y-%m-%d")
+    while date <= datetime.strptime(end_date, "%Y-%m-%d"):
+        day = date.strftime("%Y-%m-%d")
+        existing_types = [entry.type for entry in load_data_by_date(day)]
+        if any([data_type not in existing_types for data_type in fitbit_types]):
+            missing_dates.append((day, existing_types))
+        date += timedelta(days=1)
+
+    rows = []
+    try:
+        while missing_dates:
+            # Fetch from the first missing day, as far as the API allows
+            chunk_start = datetime.strptime(missing_dates[0][0], "%Y-%m-%d")
+            chunk_end = chunk_start + timedelta(days=FITBIT_MAX_RANGE_DAYS - 1)
+            chunk = [d for d in missing_dates if d[0] <= chunk_end.strftime("%Y-%m-%d")]
+            missing_dates = missing_dates[len(chunk) :]
+            data, remaining = get_fitbit_range(chunk[0][0], chunk[-1][0])
+            for day, existing_types in chunk:
+                steps, sleep = data[day]
+                if "Sleep" not in existing_types:
+                    rows.append([f"{day}T00:00", "Sleep", sleep, ""])
+                if "Steps" not in existing_types:
+                    rows.append([f"{day}T00:00", "Steps", steps, ""])
+            if remaining is not None and remaining < FITBIT_MIN_REMAINING_REQUESTS:
+                break
+    finally:
+        # Save all retrieved data at once, even if a later chunk failed
+        save_rows(rows)
+
+
 def save_fitbit_data(timezone):
     "Saves Fitbit data for the past 7 days if not already saved"
+    date = datetime.now(timezone) - timedelta(hours=6)
+    start_date = (date - timedelta(days=7)).strftime("%Y-%m-%d")
+    end_date = (date - timedelta(days=1)).strftime("%Y-%m-%d")
+    backfill_fitbit_data(start_date, end_date)
+    if FITBIT_INTRADAY:
+        backfill_intraday_data(start_date, end_date)
+        backfill_weight_data(start_date, end_date)
 
-    # Load existing data
-    data = load_data()
 
-    # Days to check
-    date = datetime.now(timezone) - timedelta(hours=6)
-    dates_to_check = [
-        (date - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(1, 8)
-    ]
-
-    # Check and retrieve missing data
-    for past_date in dates_to_check:
-        existing_data = [entry for entry in data if entry[0][:10] == past_date]
-        existing_types = [entry[1] for entry in existing_data]
-        fitbit_types = ["Sleep", "Steps"]
-        if any([data_type not in existing_types for data_type in fitbit_types]):
-            steps, sleep = get_fitbit_data(past_date)
-            if "Sleep" not in existing_types:
-                save_data([f"{past_date}T00:00", "Sleep", sleep, ""])
-            if "Steps" not in existing_types:
-                save_data([f"{past_date}T00:00", "Steps", steps, ""])
+def _get_fitbit_json(url, api_name):
+    "Returns the response of a Fitbit GET call, and the requests left (or None)"
+    access_token = get_access_token()
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = _fitbit_request("GET", url, headers=headers)
+    if response.status_code != 200:
+        raise ConnectionError(
+            f"{api_name} API Error: {response.status_code} {response.text}"
+        )
+    remaining = response.headers.get("fitbit-rate-limit-remaining")
+    return response.json(), int(remaining) if remaining is not None else None
+
+
+def _dataset_values(dataset, interval):
+    "Returns the values of an intraday dataset, one per interval, None if missing"
+    values = [None] * (MINUTES_PER_DAY // interval)
+    for point in dataset:
+        hours, minutes = point["time"].split(":")[:2]
+        values[(int(hours) * 60 + int(minutes)) // interval] = point["value"]
+    return values
+
+
+def get_intraday_data(date):
+    """
+    Gets the heart rate per minute and the steps per 15 minutes of a day.
+    Returns the values of each series, and the requests left in the current
+    rate limit window (None if unknown).
+    """
+    heart_url = (
+        f"https://api.fitbit.com/1/user/-/activities/heart/date/{date}/1d/1min.json"
+    )
+    heart, _ = _get_fitbit_json(heart_url, "Heart rate")
+    steps_url = (
+        f"https://api.fitbit.com/1/user/-/activities/steps/date/{date}/1d/15min.json"
+    )
+    steps, remaining = _get_fitbit_json(steps_url, "Activity")
+    data = {
+        "heart": _dataset_values(
+            heart.get("activities-heart-intraday", {}).get("dataset", []),
+            SERIES["heart"]["interval"],
+        ),
+        "steps": _dataset_values(
+            steps.get("activities-steps-intraday", {}).get("dataset", []),
+            SERIES["steps"]["interval"],
+        ),
+    }
+    return data, remaining
+
+
+def backfill_intraday_data(start_date, end_date):
+    """
+    Saves the intraday series missing between two dates (YYYY-MM-DD, inclusive),
+    two requests per day, until the rate limit is close to being reached.
+    """
+    date = datetime.strptime(start_date, "%Y-%m-%d")
+    while date <= datetime.strptime(end_date, "%Y-%m-%d"):
+        day = date.strftime("%Y-%m-%d")
+        date += timedelta(days=1)
+        if all(has_day(series, day) for series in SERIES):
+            continue
+        data, remaining = get_intraday_data(day)
+        for series, values in data.items():
+            save_day(series, day, values)
+        if remaining is not None and remaining < FITBIT_MIN_REMAINING_REQUESTS:
+            break
+
+
+def backfill_weight_data(start_date, end_date):
+    """
+    Saves the weight measurements between two dates (YYYY-MM-DD, inclusive, at
+    most FITBIT_MAX_WEIGHT_RANGE_DAYS apart) not already saved.
+    """
+    weight_url = f"https://api.fitbit.com/1/user/-/body/log/weight/date/{start_date}/{end_date}.json"
+    logs, _ = _get_fitbit_json(weight_url, "Weight")
+
+    rows = []
+    for log in logs.get("weight", []):
+        date = f"{log['date']}T{log.get('time', '00:00')[:5]}"
+        existing = [
+            (entry.date, entry.value)
+            for entry in load_data_by_date(log["date"])
+            if entry.type == "Weight"
+        ]
+        if (date, str(log["weight"])) not in existing:
+            rows.append([date, "Weight", log["weight"], ""])
+    save_rows(rows)
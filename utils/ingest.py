@@ -0,0 +1,110 @@
+import os
+import time
+import argparse
+import threading
+import pytz
+
+from utils.fitbit import (
+    FITBIT_CLIENT_ID,
+    FITBIT_CLIENT_SECRET,
+    has_fitbit_tokens,
+    save_fitbit_data,
+    save_fitbit_today,
+)
+from utils.calendar_api import (
+    CALENDAR_CLIENT_ID,
+    CALENDAR_CLIENT_SECRET,
+    get_credentials,
+    get_calendar_service,
+    sync_calendar_events,
+)
+from utils.storage import document_lock
+
+# 'request' ingests on dashboard views, 'thread' in a worker thread of the app,
+# 'external' relies on `python -m utils.ingest` being run on a schedule
+INGEST_MODE = os.getenv("INGEST_MODE", "request").lower()
+INGEST_INTERVAL = int(os.getenv("INGEST_INTERVAL", "900"))
+INGEST_TIMEZONE = os.getenv("INGEST_TIMEZONE", "Europe/Paris")
+
+# Lock taken by a running ingestion, next to the data file
+INGEST_LOCK_NAME = "ingest"
+
+
+def ingest_fitbit(timezone):
+    "Saves the missing past days and the current day from Fitbit"
+    if not has_fitbit_tokens():
+        return
+    save_fitbit_data(timezone)
+    save_fitbit_today(timezone)
+
+
+def ingest_calendar():
+    "Updates the local event cache with the calendar changes"
+    credentials = get_credentials()
+    if not credentials:
+        return
+    sync_calendar_events(get_calendar_service(credentials))
+
+
+def ingest(timezone):
+    """
+    Runs each configured ingestion once, errors being logged. Skipped, returning
+    False, while another worker or process is ingesting: concurrent runs would
+    save the same Fitbit days twice.
+    """
+    jobs = []
+    if FITBIT_CLIENT_ID and FITBIT_CLIENT_SECRET:
+        jobs.append(("Fitbit", lambda: ingest_fitbit(timezone)))
+    if CALENDAR_CLIENT_ID and CALENDAR_CLIENT_SECRET:
+        jobs.append(("calendar", ingest_calendar))
+    with document_lock(INGEST_LOCK_NAME, blocking=False) as locked:
+        if not locked:
+            print("Ingestion already running, skipped")
+            return False
+        for source, job in jobs:
+            try:
+                job()
+            except Exception as e:
+                print(f"Error ingesting {source} data: {e}")
+    return True
+
+
+def run_scheduler(timezone, interval=INGEST_INTERVAL, stop=None):
+    "Runs the ingestion every `interval` seconds, until stop (an Event) is set"
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        started = time.monotonic()
+        ingest(timezone)
+        stop.wait(max(0, interval - (time.monotonic() - started)))
+
+
+def start_scheduler(timezone, interval=INGEST_INTERVAL):
+    "Starts the ingestion in a daemon thread, and returns it"
+    thread = threading.Thread(
+        target=run_scheduler, args=(timezone, interval), name="ingest", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Save LifePulse data from Fitbit and Google Calendar"
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        help="keep running, ingesting every INTERVAL seconds (default: run once)",
+    )
+    parser.add_argument("--timezone", default=INGEST_TIMEZONE)
+    args = parser.parse_args()
+
+    timezone = pytz.timezone(args.timezone)
+    if args.interval:
+        run_scheduler(timezone, args.interval)
+    else:
+        ingest(timezone)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import json
+import base64
+import threading
+from datetime import date, timedelta
+import numpy as np
+from google.api_core.exceptions import PreconditionFailed
+
+from utils.storage import read_document, write_document, document_lock
+
+# Intraday series: minutes between two values, and how values are combined
+# when downsampling. Heart rates of 0 mean no measurement.
+SERIES = {
+    "heart": {"interval": 1, "dtype": "<u1", "aggregate": "mean"},
+    "steps": {"interval": 15, "dtype": "<u2", "aggregate": "sum"},
+}
+MINUTES_PER_DAY = 24 * 60
+WRITE_ATTEMPTS = 5
+# Most values returned by a query
+MAX_POINTS = 10000
+
+# Decoded month documents: name -> (version, document)
+_months = {}
+_months_lock = threading.Lock()
+
+
+def _document_name(series, month):
+    return f"intraday-{series}-{month}.json.gz"
+
+
+def _encode(array):
+    return base64.b64encode(array.tobytes()).decode()
+
+
+def _decode(text, dtype):
+    return np.frombuffer(base64.b64decode(text), dtype=dtype)
+
+
+def _read_month(series, month):
+    "Returns the version and content of a month document (shared, not to modify)"
+    name = _document_name(series, month)
+    version, text = read_document(name)
+    with _months_lock:
+        cached = _months.get(name)
+        if cached and cached[0] == version:
+            return cached
+    document = json.loads(text) if text is not None else {"days": {}, "hourly": {}}
+    with _months_lock:
+        _months[name] = (version, document)
+    return version, document
+
+
+def _hourly(values, series):
+    "Returns the sums and counts of values per hour, as one array of 48 values"
+    per_hour = 60 // SERIES[series]["interval"]
+    values = values.astype(np.uint32).reshape(24, per_hour)
+    if SERIES[series]["aggregate"] == "mean":
+        counts = (values > 0).sum(axis=1)
+    else:
+        counts = np.full(24, per_hour)
+    return np.concatenate([values.sum(axis=1), counts]).astype("<u4")
+
+
+def save_day(series, day, values):
+    """
+    Saves the values of a day (YYYY-MM-DD), a list of MINUTES_PER_DAY / interval
+    numbers (None if missing), replacing those saved before.
+
+    Each month is a compressed document holding the raw values of each day, and
+    their sums and counts per hour, so that hourly or daily queries do not
+    decode per-minute data.
+    """
+    info = SERIES[series]
+    maximum = np.iinfo(info["dtype"]).max
+    values = np.array(
+        [0 if value is None else min(round(value), maximum) for value in values],
+        dtype=info["dtype"],
+    )
+    if len(values) != MINUTES_PER_DAY // info["interval"]:
+        raise ValueError(f"Invalid number of {series} values.")
+
+    name = _document_name(series, day[:7])
+    with document_lock(name):
+        for attempt in range(WRITE_ATTEMPTS):
+            version, document = _read_month(series, day[:7])
+            document = {
+                "days": dict(document["days"], **{day: _encode(values)}),
+                "hourly": dict(
+                    document["hourly"], **{day: _encode(_hourly(values, series))}
+                ),
+            }
+            try:
+                write_document(name, json.dumps(document), if_version=version or 0)
+                return
+            except PreconditionFailed:
+                if attempt == WRITE_ATTEMPTS - 1:
+                    raise
+
+
+def has_day(series, day):
+    return day in _read_month(series, day[:7])[1]["days"]
+
+
+def _day_sums(series, document, day, hourly):
+    """
+    Returns the sums and counts of the values of a day in a month document, per
+    hour or per interval, or None if the day is missing
+    """
+    if day not in document["days"]:
+        return None
+    info = SERIES[series]
+    if hourly:
+        sums_counts = _decode(document["hourly"][day], "<u4")
+        return sums_counts[:24], sums_counts[24:]
+    values = _decode(document["days"][day], info["dtype"]).astype(np.uint32)
+    if info["aggregate"] == "mean":
+        return values, (values > 0).astype(np.uint32)
+    return values, np.ones(len(values), dtype=np.uint32)
+
+
+def load_series(series, start, end, resolution=60):
+    """
+    Returns the timestamps (YYYY-MM-DDTHH:MM) and values of a series between
+    two days included, downsampled to one value per `resolution` minutes
+    (averaged heart rate, summed steps), None where nothing was measured.
+
+    The resolution must divide a day, and be a multiple of the series interval.
+    Raises ValueError for invalid parameters, or more than MAX_POINTS values.
+    """
+    if series not in SERIES:
+        raise ValueError("Unknown series.")
+    interval = SERIES[series]["interval"]
+    if resolution <= 0 or MINUTES_PER_DAY % resolution or resolution % interval:
+        raise ValueError("Invalid resolution.")
+    start_day, end_day = date.fromisoformat(start), date.fromisoformat(end)
+    days = (end_day - start_day).days + 1
+    if days <= 0 or days * MINUTES_PER_DAY // resolution > MAX_POINTS:
+        raise ValueError("Invalid range.")
+
+    # Hourly sums are enough for resolutions of whole hours
+    hourly = resolution % 60 == 0
+    step = 60 if hourly else interval
+    per_day = MINUTES_PER_DAY // step
+    sums = np.zeros(days * per_day)
+    counts = np.zeros(days * per_day)
+    documents = {}
+    for i in range(days):
+        day = (start_day + timedelta(days=i)).isoformat()
+        if day[:7] not in documents:
+            documents[day[:7]] = _read_month(series, day[:7])[1]
+        day_sums = _day_sums(series, documents[day[:7]], day, hourly)
+        if day_sums is not None:
+            sums[i * per_day : (i + 1) * per_day] = day_sums[0]
+            counts[i * per_day : (i + 1) * per_day] = day_sums[1]
+
+    group = resolution // step
+    sums = sums.reshape(-1, group).sum(axis=1)
+    counts = counts.reshape(-1, group).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if SERIES[series]["aggregate"] == "mean":
+            values = sums / counts
+        else:
+            values = sums
+    values = [
+        None if count == 0 else round(float(value), 1)
+        for value, count in zip(values, counts)
+    ]
+
+    first = np.datetime64(start_day.isoformat(), "m")
+    timestamps = first + np.arange(len(values)) * np.timedelta64(resolution, "m")
+    return [str(timestamp) for timestamp in timestamps], values
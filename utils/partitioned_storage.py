@@ -0,0 +1,304 @@
+import os
+import json
+import secrets
+import threading
+from collections import Counter
+from google.api_core.exceptions import PreconditionFailed
+
+# The file storage helpers are read at call time: this module is imported by
+# utils.storage when it selects the backend
+from utils import storage
+from utils.records import RecordStore, format_cursor, new_record_id
+
+
+class PartitionedStorage(storage.FileStorage):
+    """
+    Stores rows in one compressed CSV chunk per month, listed in a small
+    manifest next to them, locally or in the GCS bucket. Reads only fetch the
+    partitions they need, most recent first, and a write only rewrites the
+    partitions of the rows it touches.
+
+    Partitions are never modified: a write creates new ones, then replaces the
+    manifest, which is the commit point. Parsed partitions are cached by name,
+    so a partition is downloaded once per process.
+
+    The data file is split into partitions on first use and left as it is.
+
+    get_record_store needs every partition: a new instance downloads the whole
+    history on its first call. The dashboard insights avoid it by using the
+    rollups instead (see utils.analytics.get_insight_columns).
+    """
+
+    lazy_history = True
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.manifest_name = f"{prefix}/manifest.json"
+        self._partitions = {}
+        self._store = None
+        self._lock = threading.Lock()
+
+    def _read_manifest(self):
+        "Returns the version and content of the manifest, (None, None) if missing"
+        version, text = storage._read_text(self.manifest_name)
+        if text is None:
+            return None, None
+        return version, json.loads(text)
+
+    def _load_manifest(self):
+        "Returns the current manifest, splitting the data file if there is none"
+        manifest = self._read_manifest()[1]
+        if manifest is None:
+            if (
+                storage._version(storage.FILE_NAME) is None
+                and storage._version(storage.JOURNAL_FILE_NAME) is None
+            ):
+                return {"revision": 0, "partitions": {}}
+            with storage._write_lock():
+                manifest = self._read_manifest_for_write()[1]
+        return manifest
+
+    def _read_manifest_for_write(self):
+        "Same as _load_manifest, for callers holding the write lock"
+        version, manifest = self._read_manifest()
+        if manifest is None:
+            version, manifest = None, {"revision": 0, "partitions": {}}
+            changed = {}
+            for row in storage._get_file_store().rows:
+                changed.setdefault(row[0][:7], []).append(row)
+            if changed:
+                version, manifest = self._write_partitions(version, manifest, changed)
+        return version, manifest
+
+    def _partition(self, manifest, month):
+        "Returns the RecordStore of a month, or raises FileNotFoundError"
+        name = f'{self.prefix}/{manifest["partitions"][month]["name"]}'
+        with self._lock:
+            partition = self._partitions.get(name)
+        if partition is None:
+            rows = storage._read(name)[1]
+            if rows is None:
+                # Replaced by a write since the manifest was read
+                raise FileNotFoundError(name)
+            partition = RecordStore(rows, name)
+            with self._lock:
+                self._partitions[name] = partition
+        return partition
+
+    def _read_partitions(self, read):
+        "Calls read(manifest), reading the manifest again if a partition is gone"
+        for attempt in range(storage.WRITE_ATTEMPTS):
+            manifest = self._load_manifest()
+            try:
+                return read(manifest)
+            except FileNotFoundError:
+                if attempt == storage.WRITE_ATTEMPTS - 1:
+                    raise
+
+    def _months(self, manifest, record_type=None, start=None, end=None):
+        "Returns the months with rows of a type between two days, latest first"
+        months = []
+        for month, partition in sorted(manifest["partitions"].items(), reverse=True):
+            if record_type and not partition["types"].get(record_type):
+                continue
+            if (start and month < start[:7]) or (end and month > end[:7]):
+                continue
+            months.append(month)
+        return months
+
+    def get_version(self):
+        return storage._version(self.manifest_name)
+
+    def get_record_store(self):
+        def read(manifest):
+            with self._lock:
+                store = self._store
+            if store is None or store.version != manifest["revision"]:
+                rows = []
+                for month in sorted(manifest["partitions"]):
+                    rows.extend(self._partition(manifest, month).rows)
+                store = RecordStore(rows, manifest["revision"])
+                with self._lock:
+                    self._store = store
+                    # Forget the partitions replaced since
+                    names = {
+                        f'{self.prefix}/{p["name"]}'
+                        for p in manifest["partitions"].values()
+                    }
+                    for name in list(self._partitions):
+                        if name not in names:
+                            del self._partitions[name]
+            return store
+
+        return self._read_partitions(read)
+
+    def count(self):
+        partitions = self._load_manifest()["partitions"].values()
+        return sum(partition["rows"] for partition in partitions)
+
+    def _find(self, manifest, record_id):
+        "Returns the month of a row, looking at the latest months first"
+        for month in self._months(manifest):
+            if self._partition(manifest, month).get(record_id):
+                return month
+        return None
+
+    def get(self, record_id):
+        def read(manifest):
+            month = self._find(manifest, record_id)
+            return self._partition(manifest, month).get(record_id) if month else None
+
+        return self._read_partitions(read)
+
+    def load_by_date(self, day):
+        def read(manifest):
+            if day[:7] not in manifest["partitions"]:
+                return []
+            return list(self._partition(manifest, day[:7]).get_date(day))
+
+        return self._read_partitions(read)
+
+    def load_page(self, limit, before=None, record_type=None, start=None, end=None):
+        """
+        Same as RecordStore.page. Cursors stay valid across partitions since rows
+        sharing a timestamp are in the same month.
+        """
+
+        def read(manifest):
+            rows, next_cursor, cursor = [], None, before
+            months = self._months(manifest, record_type, start, end)
+            if cursor:
+                months = [month for month in months if month <= cursor[:7]]
+            for index, month in enumerate(months):
+                partition = self._partition(manifest, month)
+                page, next_cursor = partition.page(
+                    limit - len(rows), cursor, record_type, start, end
+                )
+                rows.extend(page)
+                cursor = None
+                if len(rows) >= limit:
+                    if next_cursor is None and index + 1 < len(months):
+                        # Next page: the rows before this month
+                        next_cursor = format_cursor((month, 0))
+                    break
+            return rows, next_cursor
+
+        return self._read_partitions(read)
+
+    def get_latest_mood(self):
+        def read(manifest):
+            # Months are chronological: the latest one with moods has the latest
+            for month in self._months(manifest, "Mood"):
+                latest_mood = self._partition(manifest, month).latest_mood
+                if latest_mood is not None:
+                    return latest_mood
+            return None
+
+        return self._read_partitions(read)
+
+    def save_rows(self, rows):
+        storage._submit(storage._PendingWrite(rows=rows), self._apply)
+
+    def delete(self, record_id):
+        storage._submit(storage._PendingWrite(deleted_id=record_id), self._apply)
+
+    def _apply(self, batch):
+        "Applies a batch of pending writes to the partitions they touch"
+        version, manifest = self._read_manifest_for_write()
+        partitions = manifest["partitions"]
+        changed = {}
+        added, deleted = [], []
+        added_ids = set()
+
+        def get_rows(month):
+            if month not in changed:
+                changed[month] = []
+                if month in partitions:
+                    changed[month] = list(self._partition(manifest, month).rows)
+            return changed[month]
+
+        for write in batch:
+            write.error = None
+            if write.deleted_id is not None:
+                month = self._find(manifest, write.deleted_id)
+                rows = get_rows(month) if month else []
+                index = next(
+                    (i for i, row in enumerate(rows) if row[4] == write.deleted_id),
+                    None,
+                )
+                if index is None:
+                    write.error = ValueError("Record not found.")
+                    continue
+                deleted.append(rows.pop(index))
+            else:
+                for row in write.rows:
+                    rows = get_rows(row[0][:7])
+                    # Rows keep their ID if the write is retried
+                    if len(row) < 5:
+                        month = row[0][:7]
+                        used_ids = {}
+                        if month in partitions:
+                            used_ids = self._partition(manifest, month).by_id
+                        row.append(new_record_id(used_ids, added_ids))
+                    added_ids.add(row[4])
+                    rows.append(row)
+                added.extend(write.rows)
+
+        if changed:
+            new_version = self._write_partitions(version, manifest, changed)[0]
+            storage._update_rollups(version, new_version, added, deleted)
+
+    def _write_partitions(self, version, manifest, changed):
+        """
+        Writes new partitions for the changed months and commits them in the
+        manifest. Returns the new version and content of the manifest.
+        """
+        revision = manifest["revision"] + 1
+        partitions = dict(manifest["partitions"])
+        written = []
+        if storage.LOCAL_STORAGE:
+            os.makedirs(self.prefix, exist_ok=True)
+        for month, rows in changed.items():
+            partitions.pop(month, None)
+            if not rows:
+                continue
+            # Stable sort: new rows go after existing rows with the same date
+            rows.sort(key=lambda r: r[0])
+            # A random suffix keeps names unique if a write is interrupted
+            name = f"{month}.{revision}.{secrets.token_hex(4)}.csv.gz"
+            path = f"{self.prefix}/{name}"
+            generation = storage._write_text(
+                path, storage._format_rows(rows), if_generation_match=0
+            )
+            written.append((path, generation))
+            partitions[month] = {
+                "name": name,
+                "generation": generation,
+                "rows": len(rows),
+                "types": dict(Counter(row[1] for row in rows)),
+            }
+            with self._lock:
+                self._partitions[path] = RecordStore(rows, path)
+
+        new_manifest = {"revision": revision, "partitions": partitions}
+        try:
+            new_version = storage._write_text(
+                self.manifest_name,
+                json.dumps(new_manifest, sort_keys=True),
+                if_generation_match=version or 0,
+            )
+        except PreconditionFailed:
+            for path, generation in written:
+                storage._remove(path, if_version=generation)
+            raise
+
+        # The replaced partitions are not referenced anymore
+        for month in changed:
+            old_partition = manifest["partitions"].get(month)
+            if old_partition:
+                old_path = f'{self.prefix}/{old_partition["name"]}'
+                try:
+                    storage._remove(old_path, if_version=old_partition["generation"])
+                except Exception as e:
+                    print(f"Error removing partition {old_path}: {e}")
+        return new_version, new_manifest
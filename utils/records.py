@@ -0,0 +1,200 @@
+import hashlib
+import secrets
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+MOOD_DATE_FORMAT = "%Y-%m-%d - %Hh"
+FITBIT_DATE_FORMAT = "%Y-%m-%dT%H:%M"
+
+# Score change of a mood logged with a "+" or "-" modifier
+MOOD_MODIFIER_STEP = 1 / 3
+
+
+def get_mood_scores(moods):
+    "Maps each mood of the config to its score: 1 for the first one, 2 for the next..."
+    return {mood: index + 1 for index, mood in enumerate(moods)}
+
+
+def get_mood_score(value, mood_scores):
+    "Returns the score of a mood value, or None if the mood is unknown"
+    modifier = 0
+    if value.endswith("+"):
+        value, modifier = value[:-1], MOOD_MODIFIER_STEP
+    elif value.endswith("-"):
+        value, modifier = value[:-1], -MOOD_MODIFIER_STEP
+    score = mood_scores.get(value)
+    return None if score is None else score + modifier
+
+
+@lru_cache(maxsize=2**17)
+def parse_timestamp(row_date):
+    """
+    Returns the datetime of a row date, logged ("YYYY-MM-DD - Hh") or from
+    Fitbit ("YYYY-MM-DDTHH:MM"), or None if invalid. Each date is parsed once.
+    """
+    try:
+        if row_date[10:13] == " - " and row_date.endswith("h"):
+            hour = int(row_date[13:-1])
+        elif row_date[10:11] == "T":
+            hour = int(row_date[11:13])
+        else:
+            return None
+        return datetime(
+            int(row_date[:4]), int(row_date[5:7]), int(row_date[8:10]), hour
+        )
+    except ValueError:
+        return None
+
+
+class Record(namedtuple("Record", ["date", "type", "value", "comment", "id"])):
+    """
+    A stored row: a tuple of its columns, in file order, so it can still be
+    indexed and written as a CSV row.
+    """
+
+    __slots__ = ()
+
+    @property
+    def timestamp(self):
+        return parse_timestamp(self.date)
+
+    @property
+    def day(self):
+        return self.date[:10]
+
+
+def to_records(rows):
+    return [row if isinstance(row, Record) else Record(*row) for row in rows]
+
+
+def new_record_id(*used_ids):
+    "Returns a random record ID that is in none of the given collections"
+    while True:
+        record_id = secrets.token_hex(5)
+        if all(record_id not in ids for ids in used_ids):
+            return record_id
+
+
+def legacy_record_id(row, occurrence):
+    """
+    Returns the ID of a row stored before rows had IDs, derived from its content
+    and its occurrence among identical rows so that duplicates get distinct IDs.
+    """
+    content = "\x1f".join(row[:4] + [str(occurrence)])
+    return hashlib.blake2b(content.encode(), digest_size=5).hexdigest()
+
+
+def assign_legacy_ids(rows):
+    "Adds an ID column to the rows that have none, in place"
+    occurrences = {}
+    for row in rows:
+        if len(row) < 5:
+            row.extend([""] * (4 - len(row)))
+            key = tuple(row)
+            occurrences[key] = occurrences.get(key, 0) + 1
+            row.append(legacy_record_id(row, occurrences[key]))
+
+
+def get_timestamp_key(row_date):
+    "Returns a sortable YYYY-MM-DDTHH key of a row date, whatever its format"
+    # "YYYY-MM-DD - Hh" for logged entries, "YYYY-MM-DDTHH:MM" for Fitbit ones
+    hour = row_date[13:-1] if row_date[10:13] == " - " else row_date[11:13]
+    if not hour.isdigit():
+        return row_date[:10]
+    return f"{row_date[:10]}T{int(hour):02d}"
+
+
+def format_cursor(key):
+    timestamp, tie = key
+    return f"{timestamp}~{tie}"
+
+
+def parse_cursor(cursor):
+    "Returns the timeline key of a cursor, or raises ValueError if invalid"
+    timestamp, _, tie = cursor.rpartition("~")
+    if not timestamp:
+        raise ValueError("Invalid cursor.")
+    return timestamp, int(tie)
+
+
+class RecordStore:
+    """
+    In-memory view of the stored rows, indexed by ID, by type and by date.
+
+    Rows are kept in file order (sorted by their date column). The store is
+    immutable once built: callers must not modify the lists it returns.
+    """
+
+    def __init__(self, rows, version=None):
+        self.rows = to_records(rows)
+        self.version = version
+        self.by_id = {}
+        self.by_type = {}
+        self.by_date = {}
+        for record in self.rows:
+            self.by_id[record.id] = record
+            self.by_type.setdefault(record.type, []).append(record)
+            self.by_date.setdefault(record.day, []).append(record)
+        self.latest_mood = self._find_latest_mood()
+        self._timelines = {}
+
+    def _find_latest_mood(self):
+        # Hours are not zero-padded, so file order is not chronological for moods.
+        # On ties, the first row in file order wins.
+        latest_record, latest_timestamp = None, None
+        for record in self.by_type.get("Mood", []):
+            timestamp = record.timestamp
+            if timestamp is None:
+                continue
+            if latest_timestamp is None or timestamp > latest_timestamp:
+                latest_record, latest_timestamp = record, timestamp
+        return latest_record
+
+    def get(self, record_id):
+        return self.by_id.get(record_id)
+
+    def get_type(self, record_type):
+        return self.by_type.get(record_type, [])
+
+    def get_date(self, date):
+        return self.by_date.get(date, [])
+
+    def timeline(self, record_type=None):
+        """
+        Returns the rows in chronological order, with their sorted keys: the
+        timestamp and the rank of the row among those of the same timestamp.
+        Built on first use, once per store.
+        """
+        if record_type not in self._timelines:
+            rows = self.rows if record_type is None else self.get_type(record_type)
+            # Stable sort: rows of the same timestamp stay in file order
+            rows = sorted(rows, key=lambda r: get_timestamp_key(r.date))
+            keys = []
+            for row in rows:
+                timestamp = get_timestamp_key(row.date)
+                tie = keys[-1][1] + 1 if keys and keys[-1][0] == timestamp else 0
+                keys.append((timestamp, tie))
+            self._timelines[record_type] = (keys, rows)
+        return self._timelines[record_type]
+
+    def page(self, limit, before=None, record_type=None, start=None, end=None):
+        """
+        Returns up to `limit` rows older than the cursor `before`, most recent
+        first, optionally of one type and between two days (YYYY-MM-DD, both
+        included), with the cursor of the next page or None if it is the last.
+        """
+        keys, rows = self.timeline(record_type)
+        high = len(keys)
+        if before:
+            high = bisect_left(keys, parse_cursor(before))
+        if end:
+            next_day = date.fromisoformat(end) + timedelta(days=1)
+            high = min(high, bisect_left(keys, (next_day.isoformat(),)))
+        low = (
+            bisect_left(keys, (date.fromisoformat(start).isoformat(),)) if start else 0
+        )
+        first = max(low, high - limit)
+        next_cursor = format_cursor(keys[first]) if first > low else None
+        return rows[first:high][::-1], next_cursor
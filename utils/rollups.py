@@ -0,0 +1,99 @@
+from datetime import date, timedelta
+from functools import lru_cache
+
+from utils.records import get_mood_score
+
+# Bump when the layout of the rollups changes, so stored ones get rebuilt
+ROLLUP_VERSION = 1
+
+
+@lru_cache(maxsize=4096)
+def get_week(day):
+    "Returns the Monday (YYYY-MM-DD) of the week of a day"
+    day = date.fromisoformat(day)
+    return (day - timedelta(days=day.weekday())).isoformat()
+
+
+def _empty_bucket():
+    return {
+        "count": 0,
+        "moods": {},
+        "events": {},
+        "health": {},
+        "steps": [0, 0],
+        "sleep": [0, 0],
+    }
+
+
+def _add_count(counts, key, sign):
+    counts[key] = counts.get(key, 0) + sign
+    if counts[key] <= 0:
+        del counts[key]
+
+
+def _add_row(bucket, row, sign):
+    bucket["count"] += sign
+    record_type, value = row.type, row.value
+    if record_type == "Mood":
+        _add_count(bucket["moods"], value, sign)
+    elif record_type == "Event":
+        _add_count(bucket["events"], value, sign)
+    elif record_type == "Health":
+        _add_count(bucket["health"], value, sign)
+    elif record_type in ("Steps", "Sleep"):
+        try:
+            value = float(value)
+        except ValueError:
+            return
+        total = bucket[record_type.lower()]
+        # Rounded so that repeated additions and removals do not drift
+        total[0] = round(total[0] + sign * value, 6)
+        total[1] += sign
+
+
+def update_rollups(rollups, added=(), deleted=()):
+    "Applies added and deleted records to the per-day and per-week aggregates"
+    for sign, rows in ((1, added), (-1, deleted)):
+        for row in rows:
+            rollups["rows"] += sign
+            day = row.day
+            try:
+                week = get_week(day)
+            except ValueError:
+                continue
+            for buckets, key in ((rollups["days"], day), (rollups["weeks"], week)):
+                bucket = buckets.setdefault(key, _empty_bucket())
+                _add_row(bucket, row, sign)
+                if bucket["count"] <= 0:
+                    del buckets[key]
+    return rollups
+
+
+def build_rollups(rows):
+    rollups = {"version": ROLLUP_VERSION, "rows": 0, "days": {}, "weeks": {}}
+    return update_rollups(rollups, added=rows)
+
+
+def iter_days(start, end, step=1):
+    "Yields the days (YYYY-MM-DD) from start to end included"
+    day, end = date.fromisoformat(start), date.fromisoformat(end)
+    while day <= end:
+        yield day.isoformat()
+        day += timedelta(days=step)
+
+
+def weekly_rollups(rollups, start, end):
+    "Returns (Monday, bucket or None) for each week from start to end"
+    weeks = iter_days(get_week(start), end, step=7)
+    return [(week, rollups["weeks"].get(week)) for week in weeks]
+
+
+def mood_average(bucket, mood_scores):
+    "Returns the average mood score of a bucket, or None if it has no known mood"
+    total, count = 0, 0
+    for mood, mood_count in bucket["moods"].items():
+        score = get_mood_score(mood, mood_scores)
+        if score is not None:
+            total += score * mood_count
+            count += mood_count
+    return total / count if count else None
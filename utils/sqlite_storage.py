@@ -0,0 +1,307 @@
+import os
+import csv
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+from utils.records import (
+    Record,
+    RecordStore,
+    assign_legacy_ids,
+    get_timestamp_key,
+    new_record_id,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    date TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    type TEXT NOT NULL,
+    value TEXT NOT NULL,
+    comment TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_date ON records (date, seq);
+CREATE INDEX IF NOT EXISTS records_timestamp ON records (timestamp, seq);
+CREATE INDEX IF NOT EXISTS records_type_date ON records (type, date, seq);
+CREATE INDEX IF NOT EXISTS records_type_timestamp ON records (type, timestamp, seq);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0);
+INSERT OR IGNORE INTO meta (key, value) SELECT 'rows', COUNT(*) FROM records;
+"""
+
+COLUMNS = "date, type, value, comment, id"
+
+
+def _next_day(day):
+    return (date.fromisoformat(day) + timedelta(days=1)).isoformat()
+
+
+class SQLiteStorage:
+    """
+    Stores rows in a SQLite database, in WAL mode so that readers never wait
+    for a writer. Reads and writes are indexed queries: no request loads or
+    rewrites the whole history.
+
+    Rows are returned as records (tuples in the CSV column order, with the ID
+    last), ordered like the CSV file: by date column, then in insertion order.
+
+    `on_write(previous_version, version, added, deleted)` is called inside each
+    write transaction, with the versions of the rows before and after it.
+    """
+
+    def __init__(self, path, on_write=None):
+        self.path = path
+        self.on_write = on_write
+        self._local = threading.local()
+        self._store = None
+        self._store_lock = threading.Lock()
+
+    def _connect(self):
+        "Returns the connection of the current thread, opened on first use"
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Transactions are handled explicitly by _transaction()
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def _query(self, sql, params=()):
+        "Runs a query selecting COLUMNS and returns its rows as records"
+        return [Record(*row) for row in self._connect().execute(sql, params)]
+
+    @contextmanager
+    def _transaction(self, bump_revision=True):
+        "Runs writes in a single transaction, bumping the data revision if asked"
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if bump_revision:
+                # Bumped first, so that on_write gets the version being written
+                connection.execute(
+                    "UPDATE meta SET value = value + 1 WHERE key = 'revision'"
+                )
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    @contextmanager
+    def write_lock(self):
+        "Holds the database write lock, so that no write happens meanwhile"
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        finally:
+            connection.execute("COMMIT")
+
+    def _changed(self, connection, added, deleted):
+        connection.execute(
+            "UPDATE meta SET value = value + ? WHERE key = 'rows'",
+            (len(added) - len(deleted),),
+        )
+        if self.on_write:
+            version = self.get_version()
+            self.on_write(("sqlite", version[1] - 1), version, added, deleted)
+
+    def _get_meta(self, key):
+        row = (
+            self._connect()
+            .execute("SELECT value FROM meta WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def get_version(self):
+        "Returns a token that changes whenever the rows change"
+        return ("sqlite", self._get_meta("revision"))
+
+    def get_record_store(self):
+        "Returns an in-memory view of all the rows, reloaded when they change"
+        version = self.get_version()
+        with self._store_lock:
+            if self._store is None or self._store.version != version:
+                rows = self._query(f"SELECT {COLUMNS} FROM records ORDER BY date, seq")
+                self._store = RecordStore(rows, version)
+            return self._store
+
+    def count(self):
+        return self._get_meta("rows")
+
+    def get(self, record_id):
+        rows = self._query(f"SELECT {COLUMNS} FROM records WHERE id = ?", (record_id,))
+        return rows[0] if rows else None
+
+    def load_by_date(self, day):
+        return self._query(
+            f"SELECT {COLUMNS} FROM records WHERE date >= ? AND date < ? "
+            "ORDER BY date, seq",
+            (day, _next_day(day)),
+        )
+
+    def load_page(self, limit, before=None, record_type=None, start=None, end=None):
+        """
+        Returns up to `limit` rows older than the cursor `before`, most recent
+        first, with the cursor of the next page or None if it is the last.
+        Cursors hold the timestamp and sequence number of the last row returned.
+        """
+        conditions, params = [], []
+        if record_type:
+            conditions.append("type = ?")
+            params.append(record_type)
+        if start:
+            conditions.append("timestamp >= ?")
+            params.append(date.fromisoformat(start).isoformat())
+        if end:
+            conditions.append("timestamp < ?")
+            params.append(_next_day(end))
+        if before:
+            timestamp, _, seq = before.rpartition("~")
+            if not timestamp:
+                raise ValueError("Invalid cursor.")
+            conditions.append("(timestamp, seq) < (?, ?)")
+            params.extend([timestamp, int(seq)])
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._connect().execute(
+            f"SELECT {COLUMNS}, timestamp, seq FROM records {where} "
+            "ORDER BY timestamp DESC, seq DESC LIMIT ?",
+            params + [limit + 1],
+        )
+        rows = rows.fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1][5]}~{rows[-1][6]}"
+        return [Record(*row[:5]) for row in rows], next_cursor
+
+    def get_latest_mood(self):
+        "Returns the most recent mood row, the first one stored on ties"
+        rows = self._query(
+            f"SELECT {COLUMNS} FROM records WHERE type = 'Mood' "
+            "ORDER BY timestamp DESC, seq LIMIT 1"
+        )
+        return rows[0] if rows else None
+
+    def save_rows(self, rows):
+        "Inserts rows, giving an ID to those without one"
+        with self._transaction() as connection:
+            for row in rows:
+                if len(row) < 5:
+                    row.append(self._new_id(connection))
+                self._insert(connection, row)
+            self._changed(connection, rows, [])
+
+    def _new_id(self, connection):
+        while True:
+            record_id = new_record_id()
+            used = connection.execute(
+                "SELECT 1 FROM records WHERE id = ?", (record_id,)
+            ).fetchone()
+            if used is None:
+                return record_id
+
+    def _insert(self, connection, row):
+        connection.execute(
+            "INSERT INTO records (id, date, timestamp, type, value, comment) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (row[4], row[0], get_timestamp_key(row[0]), row[1], row[2], row[3]),
+        )
+
+    def delete(self, record_id):
+        "Deletes a row by ID and returns it, or raises ValueError if missing"
+        with self._transaction() as connection:
+            row = connection.execute(
+                f"SELECT {COLUMNS} FROM records WHERE id = ?", (record_id,)
+            ).fetchone()
+            if row is None:
+                raise ValueError("Record not found.")
+            connection.execute("DELETE FROM records WHERE id = ?", (record_id,))
+            row = Record(*row)
+            self._changed(connection, [], [row])
+        return row
+
+    def log_failed_attempt(self):
+        # Not a change of the rows: cached pages and stores stay valid
+        with self._transaction(bump_revision=False) as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) "
+                "VALUES ('last_failed_attempt', ?)",
+                (datetime.now().isoformat(),),
+            )
+
+    def get_last_failed_attempt(self):
+        last_attempt = self._get_meta("last_failed_attempt")
+        if last_attempt is None:
+            return None
+        return datetime.fromisoformat(last_attempt)
+
+    def import_csv(self, csv_path):
+        """
+        Imports the rows of a CSV data file, in file order. Rows already
+        imported (same ID) are skipped, so an import can safely be run again.
+        Returns the number of rows imported.
+        """
+        with open(csv_path, mode="r", newline="") as file:
+            rows = [row for row in csv.reader(file) if row]
+        assign_legacy_ids(rows)
+        with self._transaction() as connection:
+            imported = []
+            for row in rows:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO records "
+                    "(id, date, timestamp, type, value, comment) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (row[4], row[0], get_timestamp_key(row[0]), *row[1:4]),
+                )
+                if cursor.rowcount:
+                    imported.append(row[:5])
+            self._changed(connection, imported, [])
+        return len(imported)
+
+    def export_csv(self, csv_path):
+        "Writes all the rows to a CSV data file, sorted like the file backend"
+        tmp_path = f"{csv_path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode="w", newline="") as file:
+            writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
+            cursor = self._connect().execute(
+                f"SELECT {COLUMNS} FROM records ORDER BY date, seq"
+            )
+            count = 0
+            for row in cursor:
+                writer.writerow(row)
+                count += 1
+        os.replace(tmp_path, csv_path)
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy LifePulse data between a CSV file and a SQLite database"
+    )
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("csv_path")
+    parser.add_argument("--db", default=os.getenv("SQLITE_PATH", "data.db"))
+    args = parser.parse_args()
+
+    database = SQLiteStorage(args.db)
+    if args.command == "import":
+        count = database.import_csv(args.csv_path)
+        print(f"Imported {count} rows from {args.csv_path} into {args.db}")
+    else:
+        count = database.export_csv(args.csv_path)
+        print(f"Exported {count} rows from {args.db} to {args.csv_path}")
+
+
+if __name__ == "__main__":
+    main()
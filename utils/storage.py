@@ -3,159 +3,866 @@ import csv
 from google.cloud import storage
 from datetime import datetime
 import io
+import gzip
 import json
+import heapq
+import threading
+import tempfile
+import time
+import random
+from contextlib import contextmanager
+from urllib.parse import quote
+from google.api_core.exceptions import NotFound, NotModified, PreconditionFailed
+
+try:
+    import fcntl
+except ImportError:  # Windows: no lock between worker processes
+    fcntl = None
+
+from utils.records import (
+    RecordStore,
+    assign_legacy_ids,
+    new_record_id,
+    to_records,
+)
+from utils.rollups import ROLLUP_VERSION, build_rollups, update_rollups
+from utils.categories import get_category_classifier
+from utils.sqlite_storage import SQLiteStorage
 
 # Load Cloud Storage env variables
 PROJECT_ID = os.getenv("PROJECT_ID")
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 FILE_NAME = os.getenv("FILE_NAME", "data.csv")
 
+# Seconds between checks for changes of a config stored on GCS
+CONFIG_REVALIDATE_SECONDS = int(os.getenv("CONFIG_REVALIDATE_SECONDS", "10"))
+
+# Append-only journal: new rows and tombstones are appended to a log segment
+# which is merged into the sorted base file once it reaches the threshold
+JOURNAL_MODE = os.getenv("JOURNAL_MODE", "false").lower() == "true"
+JOURNAL_FILE_NAME = f"{FILE_NAME}.journal"
+JOURNAL_COMPACT_THRESHOLD = int(os.getenv("JOURNAL_COMPACT_THRESHOLD", "100"))
+JOURNAL_ADD = "+"
+JOURNAL_DELETE = "-"
+
+# Attempts to commit a write when another instance updated the data first
+WRITE_ATTEMPTS = 5
+
+# "file" for the CSV data file (local or on GCS), "partitioned" for monthly
+# compressed chunks of it, or "sqlite" for a database
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "file").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "data.db")
+
+# Per-day and per-week aggregates, stored next to the data file
+ROLLUPS_NAME = "rollups.json"
+
+# Local copies of the data blobs, revalidated against their GCS generation
+MIRROR_DIR = os.getenv("MIRROR_DIR") or os.path.join(tempfile.gettempdir(), "lifepulse")
+
 LOCAL_STORAGE = not all([PROJECT_ID, BUCKET_NAME])
 if not LOCAL_STORAGE:
     storage_client = storage.Client(project=PROJECT_ID)
 
 
-def load_config(config_path):
+# Parsed config shared by all callers, with artifacts derived from it
+_config = {"path": None, "version": None, "data": None, "checked_at": 0}
+_config_derived = {}
+_config_lock = threading.RLock()
+
+
+def _read_config(config_path, version):
+    "Returns the version and parsed config, or None if still at version"
     if config_path.startswith("gs://"):
         bucket_name, blob_name = config_path.split("/")[-2], config_path.split("/")[-1]
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-        if not blob.exists():
-            return {}
-        data = blob.download_as_text()
-        return json.loads(data)
+        generation, text = _fetch_blob(blob_name, bucket_name)
+        if generation is not None and generation == version:
+            return None
+        return generation, json.loads(text) if text is not None else {}
     else:
+        stat = os.stat(config_path)
+        new_version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if new_version == version:
+            return None
         with open(config_path, mode="r", newline="") as file:
-            return json.load(file)
+            return new_version, json.load(file)
+
+
+def get_config():
+    """
+    Returns the app config, parsed once and shared: callers must not modify it.
+
+    The file is checked for changes on each call, by mtime locally or by
+    generation on GCS (at most every CONFIG_REVALIDATE_SECONDS).
+    """
+    config_path = os.getenv("CONFIG_PATH", "config.json")
+    with _config_lock:
+        now = time.monotonic()
+        if (
+            _config["path"] == config_path
+            and config_path.startswith("gs://")
+            and now - _config["checked_at"] < CONFIG_REVALIDATE_SECONDS
+        ):
+            return _config["data"]
+        if _config["path"] != config_path:
+            _config["version"] = None
+        result = _read_config(config_path, _config["version"])
+        if result is not None:
+            _config["version"], _config["data"] = result
+            _config_derived.clear()
+        _config["path"] = config_path
+        _config["checked_at"] = now
+        return _config["data"]
+
+
+def get_config_version():
+    "Returns a token that changes whenever the config is reloaded"
+    get_config()
+    return (_config["path"], _config["version"])
+
+
+def _get_derived(key, build):
+    with _config_lock:
+        config = get_config()
+        if key not in _config_derived:
+            _config_derived[key] = build(config)
+        return _config_derived[key]
+
+
+def get_calendar_targets():
+    "Returns the weekly target hours of each calendar category"
+
+    def build(config):
+        config_categories = config.get("calendar_events", {})
+        target_hours = {
+            category: data.get("target", 0)
+            for category, data in config_categories.items()
+        }
+        target_hours["Other"] = 0
+        return target_hours
+
+    return _get_derived("calendar_targets", build)
 
 
-def load_data():
+def get_calendar_classifier():
+    "Returns the classifier matching event titles to calendar categories"
+    return _get_derived(
+        "calendar_classifier",
+        lambda config: get_category_classifier(config.get("calendar_events", {})),
+    )
+
+
+def _parse_rows(text):
+    return list(csv.reader(io.StringIO(text)))
+
+
+def _format_rows(rows):
+    output = io.StringIO()
+    writer = csv.writer(output, quoting=csv.QUOTE_MINIMAL)
+    writer.writerows(rows)
+    return output.getvalue()
+
+
+def _mirror_path(name, bucket_name=None):
+    bucket_name = bucket_name or BUCKET_NAME
+    return os.path.join(MIRROR_DIR, bucket_name, quote(name, safe=""))
+
+
+def _read_mirror(name, bucket_name=None):
+    "Returns the generation and content of the local copy of a blob"
+    try:
+        with open(_mirror_path(name, bucket_name), mode="r", newline="") as file:
+            generation = file.readline().strip()
+            return int(generation), file.read()
+    except (FileNotFoundError, ValueError):
+        return None, None
+
+
+def _write_mirror(name, generation, text, bucket_name=None):
+    path = _mirror_path(name, bucket_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # The generation and the content are replaced together, atomically
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, mode="w", newline="") as file:
+        file.write(f"{generation}\n{text}")
+    os.replace(tmp_path, path)
+
+
+def _remove_mirror(name, bucket_name=None):
+    try:
+        os.remove(_mirror_path(name, bucket_name))
+    except FileNotFoundError:
+        pass
+
+
+def _fetch_blob(name, bucket_name=None):
+    """
+    Returns the generation and content of a blob, or (None, None) if missing.
+
+    The local mirror is revalidated with a conditional download, so the blob is
+    only transferred when its generation changed. Blobs named *.gz are gzipped.
+    """
+    generation, text = _read_mirror(name, bucket_name)
+    blob = storage_client.bucket(bucket_name or BUCKET_NAME).blob(name)
+    try:
+        if generation is None:
+            data = blob.download_as_bytes()
+        else:
+            data = blob.download_as_bytes(if_generation_not_match=generation)
+    except NotModified:
+        return generation, text
+    except NotFound:
+        _remove_mirror(name, bucket_name)
+        return None, None
+    # Compressed blobs are mirrored uncompressed
+    if name.endswith(".gz"):
+        data = gzip.decompress(data)
+    data = data.decode()
+    _write_mirror(name, blob.generation, data, bucket_name)
+    return blob.generation, data
+
+
+def _read(name):
+    "Returns the version and rows of a file, or (None, None) if missing"
+    version, text = _read_text(name)
+    if text is None:
+        return None, None
+    return version, _parse_rows(text)
+
+
+def _version(name):
+    "Returns a token that changes whenever the file changes, or None if missing"
     if LOCAL_STORAGE:
-        if not os.path.exists(FILE_NAME):
-            return []
-        with open(FILE_NAME, mode="r", newline="") as file:
-            reader = csv.reader(file)
-            return list(reader)
+        try:
+            stat = os.stat(name)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
     else:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(FILE_NAME)
-        if not blob.exists():
-            return []
-        data = blob.download_as_text()
-        reader = csv.reader(io.StringIO(data))
-        return list(reader)
+        return _fetch_blob(name)[0]
 
 
-def save_data(row):
-    row = [str(item) for item in row]
+def _open(name, mode):
+    "Opens a local file, gzipped if named *.gz"
+    if name.endswith(".gz"):
+        return gzip.open(name, mode=f"{mode}t", newline="")
+    return open(name, mode=mode, newline="")
+
+
+def _read_text(name):
+    "Returns the version and content of a file, or (None, None) if missing"
+    if LOCAL_STORAGE:
+        version = _version(name)
+        try:
+            with _open(name, "r") as file:
+                return version, file.read()
+        except FileNotFoundError:
+            return None, None
+    else:
+        return _fetch_blob(name)
+
+
+def _write_text(name, text, if_generation_match=None):
+    "Replaces the content of a file and returns its new version"
     if LOCAL_STORAGE:
-        if not os.path.exists(FILE_NAME):
-            rows = []
+        # Write to a temporary file first so readers never see a partial file
+        tmp_name = f"{name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if name.endswith(".gz"):
+            tmp_name += ".gz"
+        with _open(tmp_name, "w") as file:
+            file.write(text)
+        os.replace(tmp_name, name)
+        return _version(name)
+    else:
+        blob = storage_client.bucket(BUCKET_NAME).blob(name)
+        if name.endswith(".gz"):
+            blob.upload_from_string(
+                gzip.compress(text.encode()),
+                content_type="application/gzip",
+                if_generation_match=if_generation_match,
+            )
         else:
-            with open(FILE_NAME, mode="r", newline="") as file:
-                reader = csv.reader(file)
-                rows = list(reader)
-        rows.append(row)
-        rows.sort(key=lambda r: r[0])
-        with open(FILE_NAME, mode="w", newline="") as file:
+            blob.upload_from_string(text, if_generation_match=if_generation_match)
+        _write_mirror(name, blob.generation, text)
+        return blob.generation
+
+
+def _write_rows(name, rows, if_version=None):
+    """
+    Replaces the content of a file.
+
+    On GCS, the upload only succeeds if the blob is still at generation
+    `if_version` (0 meaning it must not exist), otherwise PreconditionFailed is
+    raised instead of overwriting rows written by another worker. Returns the
+    new version of the file.
+    """
+    return _write_text(name, _format_rows(rows), if_generation_match=if_version or 0)
+
+
+def _remove(name, if_version=None):
+    if LOCAL_STORAGE:
+        if os.path.exists(name):
+            os.remove(name)
+    elif if_version is not None:
+        blob = storage_client.bucket(BUCKET_NAME).blob(name)
+        try:
+            blob.delete(if_generation_match=if_version)
+        except NotFound:
+            pass
+        _remove_mirror(name)
+
+
+def _append_journal(entries):
+    "Appends entries to the journal and returns its new version and length"
+    if LOCAL_STORAGE:
+        with open(JOURNAL_FILE_NAME, mode="a", newline="") as file:
             writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
-            writer.writerows(rows)
+            writer.writerows(entries)
+        with open(JOURNAL_FILE_NAME, mode="r", newline="") as file:
+            length = sum(1 for _ in csv.reader(file))
+        return _version(JOURNAL_FILE_NAME), length
     else:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(FILE_NAME)
-        if not blob.exists():
-            rows = []
+        # Objects are immutable on GCS, so the journal blob is rewritten.
+        # It stays small since it is folded into the base file regularly.
+        generation, journal = _read(JOURNAL_FILE_NAME)
+        journal = (journal or []) + entries
+        generation = _write_rows(JOURNAL_FILE_NAME, journal, if_version=generation)
+        return generation, len(journal)
+
+
+def _merge_journal(rows, journal):
+    """
+    Replays journal entries on top of the sorted base rows.
+
+    Added rows are merged after base rows sharing the same date, as a stable sort
+    of the whole file would do. Tombstones hold the ID of the deleted row.
+
+    Replaying is idempotent: if a compaction wrote the base file but could not
+    drop the journal, rows already in the base are not added again, and
+    tombstones of rows no longer there are ignored.
+    """
+    added = [entry[1:] for entry in journal if entry[0] == JOURNAL_ADD]
+    assign_legacy_ids(added)
+    ids = {row.id for row in rows}
+    new_rows = []
+    for row in added:
+        if row[4] not in ids:
+            ids.add(row[4])
+            new_rows.append(row)
+    new_rows.sort(key=lambda r: r[0])
+    merged = list(heapq.merge(rows, to_records(new_rows), key=lambda r: r[0]))
+
+    deleted_ids = {entry[1] for entry in journal if entry[0] == JOURNAL_DELETE}
+    if not deleted_ids:
+        return merged
+    return [row for row in merged if row.id not in deleted_ids]
+
+
+# Process-level cache of the parsed data, reloaded when the files change. The
+# base file is only parsed again when it changed, the journal on each change.
+_base = {"version": None, "rows": None}
+_record_store = None
+_record_store_lock = threading.Lock()
+
+
+def _get_versions():
+    "Returns the versions of the base file and of the journal"
+    base_version = _version(FILE_NAME)
+    store = _record_store
+    if JOURNAL_MODE or store is None or store.version[1] is not None:
+        return base_version, _version(JOURNAL_FILE_NAME)
+    # Without journal mode, no journal is written: once the one left by journal
+    # mode was folded by a write (or if there was none), it is no longer probed
+    return base_version, None
+
+
+def _get_file_store():
+    global _record_store
+    with _record_store_lock:
+        version = _get_versions()
+        if _record_store is not None and _record_store.version == version:
+            return _record_store
+        if _base["rows"] is None or _base["version"] != version[0]:
+            base_version, rows = _read(FILE_NAME)
+            rows = rows or []
+            # Rows stored without an ID get one derived from their content
+            assign_legacy_ids(rows)
+            _base["version"], _base["rows"] = base_version, to_records(rows)
+        journal_version, journal = None, []
+        if version[1] is not None:
+            journal_version, journal = _read(JOURNAL_FILE_NAME)
+            journal = journal or []
+        _record_store = RecordStore(
+            _merge_journal(_base["rows"], journal), (_base["version"], journal_version)
+        )
+        # Number of journal entries merged, dropped from the journal on compaction
+        _record_store.journal_length = len(journal)
+        return _record_store
+
+
+def _write_lock():
+    "Serializes writes across the worker processes sharing this disk"
+    return _file_lock(FILE_NAME)
+
+
+# Lock files held by the current thread, which can take them again
+_held_locks = threading.local()
+
+
+@contextmanager
+def _file_lock(name, blocking=True):
+    """
+    Holds an exclusive lock on a file across the worker processes of this disk.
+    Yields whether the lock is held: without blocking, False if another
+    process holds it.
+    """
+    if LOCAL_STORAGE:
+        path = f"{name}.lock"
+    else:
+        path = _mirror_path(f"{name}.lock")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    held = _held_locks.__dict__.setdefault("paths", set())
+    if path in held:
+        # A new descriptor would wait for the one this thread already holds
+        yield True
+        return
+    with open(path, mode="a") as file:
+        if fcntl:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+        held.add(path)
+        try:
+            yield True
+        finally:
+            held.discard(path)
+            if fcntl:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _drop_journal(store):
+    """
+    Removes the journal entries that were merged into the base file, and
+    returns the new version of the journal (None if removed)
+    """
+    journal_version = store.version[1]
+    if journal_version is None:
+        return None
+    try:
+        _remove(JOURNAL_FILE_NAME, if_version=journal_version)
+        return None
+    except PreconditionFailed:
+        # Entries were appended by another instance meanwhile: only keep those
+        journal_version, journal = _read(JOURNAL_FILE_NAME)
+        return _write_rows(
+            JOURNAL_FILE_NAME,
+            journal[store.journal_length :],
+            if_version=journal_version,
+        )
+
+
+def _rewrite(store, rows):
+    """
+    Writes rows as the new base file and drops the journal merged into them.
+    Returns the new version of the data.
+    """
+    base_version = _write_rows(FILE_NAME, rows, if_version=store.version[0])
+    try:
+        journal_version = _drop_journal(store)
+    except Exception as e:
+        # The rows are committed: the journal is replayed without duplicating
+        # them until the next compaction drops it
+        print(f"Error dropping the journal: {e}")
+        journal_version = store.version[1]
+    return base_version, journal_version
+
+
+def _compact(store):
+    "Folds the journal merged in store into the base file"
+    version = _rewrite(store, store.rows)
+    # Same rows: the rollups only get the new version
+    _update_rollups(store.version, version)
+
+
+def compact_journal():
+    "Folds the journal into the sorted base file"
+    with _write_lock():
+        _compact(_get_file_store())
+
+
+class _PendingWrite:
+    "Rows to add or the ID of a row to delete, waiting to be committed"
+
+    def __init__(self, rows=None, deleted_id=None):
+        self.rows = rows or []
+        self.deleted_id = deleted_id
+        self.error = None
+        self.done = threading.Event()
+
+
+# Writes queued by concurrent requests are committed together
+_pending_writes = []
+_pending_writes_lock = threading.Lock()
+_commit_lock = threading.Lock()
+
+
+def _apply(store, batch):
+    "Applies a batch of pending writes on top of the current data"
+    journal = []
+    added, deleted = [], []
+    added_ids, deleted_ids = set(), set()
+    for write in batch:
+        write.error = None
+        if write.deleted_id is not None:
+            row = store.get(write.deleted_id)
+            if row is None or write.deleted_id in deleted_ids:
+                write.error = ValueError("Record not found.")
+                continue
+            deleted_ids.add(write.deleted_id)
+            deleted.append(row)
+            journal.append([JOURNAL_DELETE, write.deleted_id])
         else:
-            data = blob.download_as_text()
-            reader = csv.reader(io.StringIO(data))
-            rows = list(reader)
-        rows.append(row)
+            for row in write.rows:
+                # Rows keep their ID if the write is retried
+                if len(row) < 5:
+                    row.append(new_record_id(store.by_id, added_ids))
+                added_ids.add(row[4])
+            added.extend(write.rows)
+            journal.extend([JOURNAL_ADD] + row for row in write.rows)
+
+    if not JOURNAL_MODE:
+        rows = [row for row in store.rows if row[4] not in deleted_ids] + added
+        # Stable sort: new rows go after existing rows with the same date
         rows.sort(key=lambda r: r[0])
-        output = io.StringIO()
-        writer = csv.writer(output, quoting=csv.QUOTE_MINIMAL)
-        writer.writerows(rows)
-        blob.upload_from_string(output.getvalue())
+        version = _rewrite(store, rows)
+        _update_rollups(store.version, version, added, deleted)
+    elif journal:
+        journal_version, journal_length = _append_journal(journal)
+        version = (store.version[0], journal_version)
+        _update_rollups(store.version, version, added, deleted)
+        if journal_length >= JOURNAL_COMPACT_THRESHOLD:
+            try:
+                _compact(_get_file_store())
+            except PreconditionFailed:
+                # The journal is committed, compaction is retried on next write
+                pass
+
+
+def _commit(batch, apply=None):
+    "Applies a batch with `apply(batch)`, or to the data file by default"
+    with _write_lock():
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                if apply:
+                    apply(batch)
+                else:
+                    _apply(_get_file_store(), batch)
+                return
+            except PreconditionFailed:
+                # Another instance wrote in the meantime: start over from its data
+                if attempt == WRITE_ATTEMPTS - 1:
+                    raise
+                time.sleep(random.uniform(0, 0.1 * 2**attempt))
+
 
+def _submit(write, apply=None):
+    """
+    Queues a write and waits until it is committed.
 
-def delete_data(target_row):
+    The first thread to get the commit lock commits every queued write in a
+    single rewrite, so concurrent requests do not each rewrite the whole file.
+    """
+    with _pending_writes_lock:
+        _pending_writes.append(write)
+    with _commit_lock:
+        if not write.done.is_set():
+            with _pending_writes_lock:
+                batch = list(_pending_writes)
+                _pending_writes.clear()
+            try:
+                _commit(batch, apply)
+            except Exception as e:
+                for pending_write in batch:
+                    pending_write.error = e
+            finally:
+                for pending_write in batch:
+                    pending_write.done.set()
+    if write.error:
+        raise write.error
+
+
+def get_document_name(name):
+    "Returns the name of a file stored next to the data file"
+    return os.path.join(os.path.dirname(FILE_NAME), name)
+
+
+# Parsed JSON documents, reloaded when the files change
+_documents = {}
+_documents_lock = threading.Lock()
+
+
+def load_json(name):
+    """
+    Loads a JSON document stored next to the data file, or None if missing.
+    The parsed document is cached and shared: callers must not modify it.
+    """
+    name = get_document_name(name)
+    # Locally a stat tells whether the file changed. On GCS, a single
+    # conditional download does, returning the mirrored text if it did not.
     if LOCAL_STORAGE:
-        if not os.path.exists(FILE_NAME):
-            raise ValueError("Data file does not exist.")
-        with open(FILE_NAME, mode="r", newline="") as file:
-            reader = csv.reader(file)
-            rows = list(reader)
-        # Attempt to find and remove the target row
-        row_found = False
-        for existing_row in rows:
-            if existing_row == target_row:
-                rows.remove(existing_row)
-                row_found = True
-                break
-        if not row_found:
-            raise ValueError("Record not found.")
-        # Write the updated rows back to the CSV
-        with open(FILE_NAME, mode="w", newline="") as file:
-            writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
-            writer.writerows(rows)
+        version, text = _version(name), None
     else:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(FILE_NAME)
-        if not blob.exists():
+        version, text = _fetch_blob(name)
+    with _documents_lock:
+        cached = _documents.get(name)
+        if cached and cached[0] == version:
+            return cached[1]
+    if LOCAL_STORAGE:
+        version, text = _read_text(name)
+    data = json.loads(text) if text is not None else None
+    with _documents_lock:
+        _documents[name] = (version, data)
+    return data
+
+
+def save_json(name, data):
+    "Saves a JSON document next to the data file"
+    _write_text(get_document_name(name), json.dumps(data))
+
+
+def get_document_version(name):
+    "Returns a token that changes whenever a document changes, or None if missing"
+    return _version(get_document_name(name))
+
+
+def read_document(name):
+    "Returns the version and text of a document stored next to the data file"
+    return _read_text(get_document_name(name))
+
+
+def write_document(name, text, if_version=None):
+    """
+    Replaces the text of a document stored next to the data file, and returns
+    its new version. On GCS, the upload only succeeds if the document is still
+    at `if_version` (0 meaning it must not exist), otherwise PreconditionFailed
+    is raised.
+    """
+    return _write_text(get_document_name(name), text, if_generation_match=if_version)
+
+
+def document_lock(name, blocking=True):
+    "Serializes the updates of a document across the worker processes"
+    return _file_lock(get_document_name(name), blocking)
+
+
+def _read_rollups():
+    "Returns the version and content of the rollups, None if missing or invalid"
+    version, text = _read_text(get_document_name(ROLLUPS_NAME))
+    try:
+        return version, json.loads(text) if text is not None else None
+    except ValueError:
+        return version, None
+
+
+def _save_rollups(version, rollups):
+    _write_text(
+        get_document_name(ROLLUPS_NAME),
+        json.dumps(rollups, ensure_ascii=False),
+        if_generation_match=version or 0,
+    )
+
+
+def _version_token(version):
+    "Returns a data version as stored in JSON documents (tuples become lists)"
+    return json.loads(json.dumps(version))
+
+
+def _rollups_match(rollups, data_version):
+    "Tells whether rollups were built from the data at data_version"
+    return (
+        rollups is not None
+        and rollups.get("version") == ROLLUP_VERSION
+        and rollups.get("data_version") == _version_token(data_version)
+    )
+
+
+def _update_rollups(previous_version, version, added=(), deleted=()):
+    """
+    Applies committed rows to the rollups, if they matched the data before the
+    write (at previous_version), and marks them with the version written.
+    Otherwise they are left to be rebuilt on the next read.
+    """
+    try:
+        rollups_version, rollups = _read_rollups()
+        if _rollups_match(rollups, previous_version):
+            update_rollups(rollups, to_records(added), to_records(deleted))
+            rollups["data_version"] = _version_token(version)
+            _save_rollups(rollups_version, rollups)
+    except Exception as e:
+        # The rows are committed either way: the rollups get rebuilt on next read
+        print(f"Error updating rollups: {e}")
+
+
+def get_rollups():
+    """
+    Returns the per-day and per-week aggregates of the data, rebuilt from
+    scratch only when they are missing or do not match the data.
+    The returned document is shared: callers must not modify it.
+    """
+    try:
+        rollups = load_json(ROLLUPS_NAME)
+    except ValueError:
+        rollups = None
+    if _rollups_match(rollups, backend.get_version()):
+        return rollups
+    with backend.write_lock():
+        version, rollups = _read_rollups()
+        # Read before the rows: rollups of rows written meanwhile are rebuilt
+        data_version = backend.get_version()
+        if not _rollups_match(rollups, data_version):
+            rollups = build_rollups(backend.get_record_store().rows)
+            rollups["data_version"] = _version_token(data_version)
+            try:
+                _save_rollups(version, rollups)
+            except PreconditionFailed:
+                # Another instance saved them meanwhile, they are checked next time
+                pass
+    return rollups
+
+
+class FileStorage:
+    """
+    Stores rows in the CSV data file, locally or in the GCS bucket, and serves
+    reads from an in-memory RecordStore reloaded when the file changes.
+    """
+
+    # Whether get_record_store fetches rows that reads do not otherwise need
+    lazy_history = False
+
+    def get_version(self):
+        return _get_versions()
+
+    def get_record_store(self):
+        return _get_file_store()
+
+    def write_lock(self):
+        return _write_lock()
+
+    def count(self):
+        return len(_get_file_store().rows)
+
+    def get(self, record_id):
+        return _get_file_store().get(record_id)
+
+    def load_by_date(self, day):
+        return list(_get_file_store().get_date(day))
+
+    def load_page(self, limit, before=None, record_type=None, start=None, end=None):
+        return _get_file_store().page(limit, before, record_type, start, end)
+
+    def get_latest_mood(self):
+        return _get_file_store().latest_mood
+
+    def save_rows(self, rows):
+        _submit(_PendingWrite(rows=rows))
+
+    def delete(self, record_id):
+        if _get_file_store().version == (None, None):
             raise ValueError("Data file does not exist.")
-        data = blob.download_as_text()
-        reader = csv.reader(io.StringIO(data))
-        rows = list(reader)
-        # Attempt to find and remove the target row
-        row_found = False
-        for existing_row in rows:
-            if existing_row == target_row:
-                rows.remove(existing_row)
-                row_found = True
-                break
-        if not row_found:
-            raise ValueError("Record not found.")
-        # Write the updated rows back to the CSV
-        output = io.StringIO()
-        writer = csv.writer(output, quoting=csv.QUOTE_MINIMAL)
-        writer.writerows(rows)
-        blob.upload_from_string(output.getvalue())
+        _submit(_PendingWrite(deleted_id=record_id))
+
+    def log_failed_attempt(self):
+        if LOCAL_STORAGE:
+            with open("last_failed_attempt.txt", "w") as file:
+                current_time = datetime.now().isoformat()
+                file.write(current_time)
+        else:
+            bucket = storage_client.bucket(BUCKET_NAME)
+            blob = bucket.blob("last_failed_attempt.txt")
+            current_time = datetime.now().isoformat()
+            blob.upload_from_string(current_time)
+
+    def get_last_failed_attempt(self):
+        if LOCAL_STORAGE:
+            if not os.path.exists("last_failed_attempt.txt"):
+                return None
+            with open("last_failed_attempt.txt", "r") as file:
+                last_attempt = file.read().strip()
+            return datetime.fromisoformat(last_attempt)
+        else:
+            bucket = storage_client.bucket(BUCKET_NAME)
+            blob = bucket.blob("last_failed_attempt.txt")
+            if not blob.exists():
+                return None
+            last_attempt = blob.download_as_text().strip()
+            return datetime.fromisoformat(last_attempt)
+
+
+# The backend holding the rows: all implement the same methods
+if STORAGE_BACKEND == "sqlite":
+    backend = SQLiteStorage(SQLITE_PATH, on_write=_update_rollups)
+elif STORAGE_BACKEND == "partitioned":
+    # Imported here: the partitioned storage builds on the file storage above
+    from utils.partitioned_storage import PartitionedStorage
+
+    backend = PartitionedStorage(os.path.splitext(FILE_NAME)[0])
+else:
+    backend = FileStorage()
+
+
+def get_data_version():
+    "Returns a token that changes whenever the rows change"
+    return backend.get_version()
+
+
+def get_record_store():
+    "Returns an in-memory view of all the rows, for whole-history analyses"
+    return backend.get_record_store()
+
+
+def has_lazy_history():
+    "Whether get_record_store downloads rows on demand, costly on a new instance"
+    return getattr(backend, "lazy_history", False)
+
+
+def load_history_page(limit, before=None, record_type=None, start=None, end=None):
+    "Returns a page of rows, most recent first, and the cursor of the next page"
+    return backend.load_page(limit, before, record_type, start, end)
+
+
+def load_data_by_date(date):
+    "Returns the rows of a given day (YYYY-MM-DD)"
+    return backend.load_by_date(date)
+
+
+def save_rows(rows):
+    "Saves several rows at once, with a single write of the data"
+    rows = [[str(item) for item in row] for row in rows]
+    if rows:
+        backend.save_rows(rows)
+
+
+def save_data(row):
+    save_rows([row])
+
+
+def delete_data(record_id):
+    if not record_id:
+        raise ValueError("Record not found.")
+    backend.delete(record_id)
 
 
 def get_latest_mood():
-    data = load_data()
-    mood_entries = [row for row in data if row[1] == "Mood"]
-    if not mood_entries:
+    latest_mood = backend.get_latest_mood()
+    if latest_mood is None:
         return None
-    mood_entries.sort(
-        key=lambda x: datetime.strptime(x[0], "%Y-%m-%d - %Hh"), reverse=True
-    )
-    latest_mood = mood_entries[0][2]
-    return latest_mood
+    return latest_mood[2]
 
 
 def log_failed_attempt():
-    if LOCAL_STORAGE:
-        with open("last_failed_attempt.txt", "w") as file:
-            current_time = datetime.now().isoformat()
-            file.write(current_time)
-    else:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob("last_failed_attempt.txt")
-        current_time = datetime.now().isoformat()
-        blob.upload_from_string(current_time)
+    backend.log_failed_attempt()
 
 
 def get_last_failed_attempt():
-    if LOCAL_STORAGE:
-        if not os.path.exists("last_failed_attempt.txt"):
-            return None
-        with open("last_failed_attempt.txt", "r") as file:
-            last_attempt = file.read().strip()
-        return datetime.fromisoformat(last_attempt)
-    else:
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob("last_failed_attempt.txt")
-        if not blob.exists():
-            return None
-        last_attempt = blob.download_as_text().strip()
-        return datetime.fromisoformat(last_attempt)
+    return backend.get_last_failed_attempt()
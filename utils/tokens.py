@@ -0,0 +1,94 @@
+import os
+import json
+import base64
+import hashlib
+import threading
+from functools import lru_cache
+from cryptography.fernet import Fernet, InvalidToken
+from google.api_core.exceptions import PreconditionFailed
+
+from utils.storage import read_document, write_document, document_lock
+
+# Refreshes of this process, one at a time (document_lock covers the others)
+_refresh_lock = threading.Lock()
+
+# Public secrets (app default and .env.example): no key is derived from them
+PUBLIC_SECRET_KEYS = ("secret_key", "your_flask_app_secret_key")
+
+
+@lru_cache(maxsize=1)
+def _get_fernet():
+    """
+    Returns the cipher of the token store, keyed by TOKEN_ENCRYPTION_KEY (from
+    Fernet.generate_key()), or by a key derived from APP_SECRET_KEY if unset.
+    Returns None if neither is set, as a key derived from a public secret would
+    not protect the tokens.
+    """
+    key = os.getenv("TOKEN_ENCRYPTION_KEY")
+    if not key:
+        secret = os.getenv("APP_SECRET_KEY", "secret_key")
+        if secret in PUBLIC_SECRET_KEYS:
+            print(
+                "WARNING: set TOKEN_ENCRYPTION_KEY or APP_SECRET_KEY to connect "
+                "Fitbit or Google Calendar, tokens are not stored without them"
+            )
+            return None
+        key = base64.urlsafe_b64encode(hashlib.sha256(secret.encode()).digest())
+    return Fernet(key)
+
+
+def _read_tokens(name):
+    "Returns the version and decrypted content of a token document"
+    version, text = read_document(name)
+    if text is None or _get_fernet() is None:
+        return version, None
+    try:
+        return version, json.loads(_get_fernet().decrypt(text.encode()))
+    except InvalidToken:
+        # Not written with this key: the connection must be made again
+        print(f"Unable to decrypt {name}, ignoring it")
+        return version, None
+
+
+def load_tokens(name):
+    "Returns the tokens stored in a document, or None if missing"
+    return _read_tokens(name)[1]
+
+
+def save_tokens(name, tokens, if_version=None):
+    """
+    Encrypts and stores tokens in a document, and returns its new version.
+    Raises ValueError if no encryption key is set.
+    """
+    fernet = _get_fernet()
+    if fernet is None:
+        raise ValueError("Tokens cannot be stored without an encryption key.")
+    text = fernet.encrypt(json.dumps(tokens).encode()).decode()
+    return write_document(name, text, if_version=if_version)
+
+
+def get_fresh_tokens(name, needs_refresh, refresh):
+    """
+    Returns the stored tokens, refreshed first if `needs_refresh(tokens)`.
+
+    `refresh(tokens)` returns the new tokens, or None if the refresh failed (in
+    which case None is returned). Refreshes are single-flight: threads and
+    workers wait for the one in progress, then use the tokens it stored.
+    """
+    tokens = load_tokens(name)
+    if tokens is None or not needs_refresh(tokens):
+        return tokens
+    with _refresh_lock, document_lock(name):
+        # Another worker may have refreshed them while this one was waiting
+        version, tokens = _read_tokens(name)
+        if tokens is None or not needs_refresh(tokens):
+            return tokens
+        new_tokens = refresh(tokens)
+        if new_tokens is None:
+            return None
+        try:
+            save_tokens(name, new_tokens, if_version=version or 0)
+        except PreconditionFailed:
+            # Refreshed meanwhile by another instance: its tokens are kept
+            return load_tokens(name)
+        return new_tokens